@@ -10,6 +10,7 @@ TODO
  recursive update
 
 """
+import math
 import time
 from datetime import datetime, timedelta
 import re
@@ -28,10 +29,11 @@ from piston.utils import rc, FormValidationError
 from piston.decorator import decorator
 
 from models import Droplet, DropletRevision, Cell, CellRevision,\
-     Share, UserResource, UserProfile
+     Share, UserResource, UserProfile, Change, UploadSession, Blob
 
 from exceptions import APIBadRequest, APIForbidden, APINotFound
 import common
+import notify
 
 @decorator
 def check_read_permission(function, self, request, *args, **kwargs):
@@ -39,11 +41,11 @@ def check_read_permission(function, self, request, *args, **kwargs):
 
     if isinstance(self, DropletHandler) or \
        isinstance(self, DropletRevisionHandler):
-        obj = Droplet.objects.get(pk=args[0])
+        obj = Droplet.objects.select_related('cell').get(pk=args[0])
         cell = obj.cell
 
     elif isinstance(self, DropletRevisionDataHandler):
-        obj = Droplet.objects.get(pk=args[1])
+        obj = Droplet.objects.select_related('cell').get(pk=args[1])
         cell = obj.cell
 
     elif isinstance(self, CellHandler) or isinstance(self, CellShareHandler):
@@ -52,13 +54,12 @@ def check_read_permission(function, self, request, *args, **kwargs):
 
     if cell:
         # now do the check
-        if cell.owner == request.user:
+        if cell.owner_id == request.user.id:
             return function(self, request, *args, **kwargs)
 
         else:
-            shares = Share.objects.filter(Q(cell__in=cell.get_ancestors()) |\
-                                          Q(cell=cell)).filter(user=request.user)
-            if shares:
+            shares = cell.get_shares().filter(user=request.user)
+            if shares.count():
                 return function(self, request, *args, **kwargs)
             else:
                 raise APIForbidden("Permission denied")
@@ -67,14 +68,13 @@ def check_read_permission(function, self, request, *args, **kwargs):
 
 
 def _check_write_permission(user, cell):
-    if cell.owner == user:
+    if cell.owner_id == user.id:
         return True
 
     else:
-        shares = Share.objects.filter(Q(cell__in=cell.get_ancestors()) |\
-                                      Q(cell=cell)).filter(user=user, mode=1)
+        shares = cell.get_shares().filter(user=user, mode=1)
 
-        if shares:
+        if shares.count():
             return True
 
         else:
@@ -92,11 +92,20 @@ def check_write_permission(function, self, request, *args, **kwargs):
             cells.append(Cell.objects.get(pk=request.POST.get('cell', None)))
 
         else:
-            obj = Droplet.objects.get(pk=kwargs.get('droplet_id', None))
+            obj = Droplet.objects.select_related('cell').\
+                  get(pk=kwargs.get('droplet_id', None))
             cells.append(obj.cell)
 
+    elif isinstance(self, DropletBatchHandler):
+        # all the cells to put droplets into, checked once each
+        cell_ids = set(_batch_cell_ids(request))
+        cells.extend(Cell.objects.filter(pk__in=cell_ids))
+        if len(cells) != len(cell_ids):
+            raise Cell.DoesNotExist()
+
     elif isinstance(self, DropletRevisionHandler):
-        obj = Droplet.objects.get(pk=kwargs.get('droplet_id', None))
+        obj = Droplet.objects.select_related('cell').\
+              get(pk=kwargs.get('droplet_id', None))
         cells.append(obj.cell)
 
         # if this is a "move" then also fetch the cell to move into
@@ -179,6 +188,41 @@ class ResourceForm(forms.ModelForm):
 
         return resource
 
+def _request_files(request):
+    """
+    Return the files posted with request and the upload session they
+    come from, if the content was uploaded through one
+    """
+    if not request.POST.get('upload'):
+        return request.FILES, None
+
+    try:
+        session = UploadSession.objects.get(pk=request.POST['upload'],
+                                            owner=request.user)
+    except (UploadSession.DoesNotExist, ValueError):
+        raise APINotFound({'error': "Upload not found"})
+
+    name = request.POST.get('name') or 'content'
+    return {'content': session.uploaded_file(name)}, session
+
+def _batch_cell_ids(request):
+    """ Return the cell ids posted to DropletBatchHandler as integers
+    """
+    try:
+        return [int(cell_id) for cell_id in request.POST.getlist('cell')]
+    except ValueError:
+        raise APIBadRequest({'cell': 'Bad cell id'})
+
+def _finish_upload(files, session):
+    """ Remove the upload session once its content got committed.
+    Until then the session keeps its staged file, so a rolled back
+    request can be posted again.
+    """
+    if session:
+        files['content'].close()
+        with transaction.commit_on_success():
+            session.delete()
+
 def _recursive_update_shares(cell, user):
     """
     """
@@ -194,8 +238,7 @@ def _recursive_update_shares(cell, user):
     else:
         parent = cell.share_set.get(user=user).parent
 
-    shares = Share.objects.filter(Q(cell__in=parent.get_ancestors()) |\
-                                  Q(cell=parent))
+    shares = parent.get_shares()
 
     if shares.count():
         share_root = shares[0].cell
@@ -221,7 +264,8 @@ def _recursive_update_shares(cell, user):
 class DropletRevisionCreateForm(ResourceForm):
     class Meta:
         model = DropletRevision
-        fields = ('name', 'cell', 'content', 'content_sha256', 'number')
+        fields = ('name', 'cell', 'content', 'content_sha256', 'number',
+                  'patch', 'patch_sha256')
 
 class DropletRevisionHandler(BaseHandler):
     allowed_methods = ('GET', 'POST', 'DELETE')
@@ -243,8 +287,17 @@ class DropletRevisionHandler(BaseHandler):
 
     @check_write_permission
     @add_server_timestamp
+    def create(self, request, **kwargs):
+        # check_write_permission looks for droplet_id in the keyword
+        # arguments, which the decorators pass on only as they come
+        files, session = _request_files(request)
+        droplet = self._create(request, kwargs['droplet_id'], files)
+        _finish_upload(files, session)
+
+        return droplet
+
     @transaction.commit_on_success()
-    def create(self, request, droplet_id):
+    def _create(self, request, droplet_id, files):
         droplet = Droplet.objects.get(pk=droplet_id)
         resource, created = UserResource.objects.get_or_create(user=request.user,
                                                                name=request.POST.get('resource', 'melissi')
@@ -257,7 +310,7 @@ class DropletRevisionHandler(BaseHandler):
                                    )
         form = DropletRevisionCreateForm(request.user,
                                          request.POST,
-                                         request.FILES,
+                                         files,
                                          instance=revision)
 
         if not form.is_valid():
@@ -269,51 +322,17 @@ class DropletRevisionHandler(BaseHandler):
 
         elif form.instance.number < droplet.revisions + 1:
             # houston we have a conflict
-            # create a new droplet
-            new_droplet = Droplet(name=droplet.name,
-                                  owner=droplet.owner,
-                                  created=droplet.created,
-                                  cell=droplet.cell,
-                                  content=droplet.content,
-                                  patch=droplet.patch,
-                                  content_sha256=droplet.content_sha256,
-                                  patch_sha256=droplet.patch_sha256,
-                                  deleted=droplet.deleted)
-
-            new_droplet.save()
-
-            # delete autogenerated revisions
+            # fork a new droplet from the revisions before the
+            # conflicting one
+            droplet = droplet.fork(form.instance.number)
+            form.instance.droplet = droplet
+
+        if form.instance.patch and not form.instance.content:
+            # patch only revision, build content on the server
             try:
-                new_droplet.dropletrevision_set.all().delete()
-            except ObjectDoesNotExist:
-                # _update_droplet will raise DoesNotExist that we
-                # can safetly ignore, since we will create manually
-                # the revisions
-                pass
-
-            # copy revisions
-            for rev in droplet.dropletrevision_set.all().order_by("number"):
-                if rev.number == form.instance.number:
-                    # don't copy conflicting revision
-                    # break since its the last to copy
-                    break
-
-                new_rev = DropletRevision(droplet=new_droplet,
-                                          resource=rev.resource,
-                                          name=rev.name,
-                                          number=rev.number,
-                                          cell=rev.cell,
-                                          content=rev.content,
-                                          patch=rev.patch,
-                                          content_sha256=rev.content_sha256,
-                                          patch_sha256=rev.patch_sha256
-                                          )
-
-                new_rev.save()
-
-            # set new_droplet
-            droplet = new_droplet
-            form.instance.droplet = new_droplet
+                form.instance.apply_patch()
+            except ValidationError, error:
+                raise APIBadRequest({'error': error.messages})
 
         form.save()
 
@@ -335,6 +354,21 @@ class DropletRevisionHandler(BaseHandler):
 
         return rc.DELETED
 
+def _content_revision(droplet, revision_number=None):
+    """
+    Return the revision with the latest content entry with
+    revision_number less than or equal to revision_number, or the
+    latest one
+    """
+    revisions = droplet.dropletrevision_set.filter(content_sha256__isnull=False)
+    if revision_number:
+        revisions = revisions.filter(number__lte=revision_number)
+
+    try:
+        return revisions.reverse()[0]
+    except IndexError:
+        raise DropletRevision.DoesNotExist
+
 class DropletRevisionDataHandler(BaseHandler):
     allowed_methods = ('GET', )
 
@@ -342,24 +376,58 @@ class DropletRevisionDataHandler(BaseHandler):
     @watchdog_notfound
     def read(self, request, type, droplet_id, revision_number=None):
         droplet = Droplet.objects.get(pk=droplet_id)
+        if type == 'signature':
+            revision = _content_revision(droplet, revision_number)
+            return common.sendfile(revision.signature_file(), request=request,
+                                   etag=revision.content_sha256)
+
+        elif type == 'delta':
+            # delta from the content the client has, given by
+            # revision number or by sha256
+            revision = _content_revision(droplet, revision_number)
+            if request.GET.get('from_sha256'):
+                base = droplet.dropletrevision_set.filter(
+                    content_sha256=request.GET['from_sha256'])[:1]
+                if not base:
+                    raise DropletRevision.DoesNotExist
+                base = base[0]
+
+            elif request.GET.get('from', '').isdigit():
+                base = _content_revision(droplet, request.GET['from'])
+
+            else:
+                raise APIBadRequest({'error': 'Need from or from_sha256'})
+
+            return common.sendfile(revision.delta_from(base), request=request,
+                                   etag='%s-%s' % (base.content_sha256,
+                                                   revision.content_sha256))
+
         if revision_number:
             # find the revision with the latest name entry with
-            # revision_number less than or equal to revision_number
-            name = droplet.dropletrevision_set.filter(name__isnull=False,
-                                                      number__lte=revision_number)[0].name
+            # revision_number less than or equal to revision_number,
+            # pruning may have removed all of them
+            names = droplet.dropletrevision_set.filter(name__isnull=False,
+                                                       number__lte=revision_number).reverse()[:1]
+            if not names:
+                raise DropletRevision.DoesNotExist
+            name = names[0].name
 
             # find the revision with the latest content entry with
             # revision_number less than or equal to revision_number
-            fileobj = getattr(droplet.dropletrevision_set.filter(content_sha256__isnull=False,
-                                                              number__lte=revision_number)[0],
-                           type)
+            revision = _content_revision(droplet, revision_number)
+            if type == 'content':
+                fileobj = revision.content_file()
+            else:
+                fileobj = revision.patch
+
+            etag = getattr(revision, '%s_sha256' % type)
 
         else:
-            revision = droplet.dropletrevision_set.latest()
             name = droplet.name
             fileobj = getattr(droplet, type)
+            etag = getattr(droplet, '%s_sha256' % type)
 
-        return common.sendfile(fileobj, name)
+        return common.sendfile(fileobj, name, request=request, etag=etag)
 
 class DropletCreateForm(ResourceForm):
     # caution we use our home brewed FileField form item to allow
@@ -383,18 +451,26 @@ class DropletHandler(BaseHandler):
     @watchdog_notfound
     @check_read_permission
     def read(self, request, droplet_id):
-        droplet = Droplet.objects.get(pk=droplet_id)
+        droplet = Droplet.objects.select_related('cell__owner', 'owner').\
+                  get(pk=droplet_id)
         return droplet
 
     @add_server_timestamp
     @watchdog_notfound
     @check_write_permission
-    @transaction.commit_on_success()
     def create(self, request):
+        files, session = _request_files(request)
+        droplet = self._create(request, files)
+        _finish_upload(files, session)
+
+        return droplet
+
+    @transaction.commit_on_success()
+    def _create(self, request, files):
         droplet = Droplet(owner=request.user)
         form = DropletCreateForm(request.user,
                                  request.POST,
-                                 request.FILES,
+                                 files,
                                  instance=droplet
                                  )
         if not form.is_valid():
@@ -418,6 +494,125 @@ class DropletHandler(BaseHandler):
 
         return rc.DELETED
 
+class DropletBatchHandler(BaseHandler):
+    """
+    Create many droplets with one request.
+
+    Expects lists of equal length of 'name', 'cell', 'content_sha256'
+    and 'content' files, one entry per droplet. All droplets are
+    created in one transaction with one permission check per cell and
+    one quota update per cell.
+    """
+    allowed_methods = ('POST', )
+
+    @add_server_timestamp
+    @watchdog_notfound
+    @check_write_permission
+    def create(self, request):
+        stored = []
+        try:
+            with transaction.commit_on_success():
+                return self._create(request, stored)
+        except Exception:
+            # blobs saved before the rollback lost their Blob rows,
+            # without one collect_garbage never finds them
+            for content_sha256 in stored:
+                Blob.add_unreferenced(content_sha256)
+            raise
+
+    def _create(self, request, stored):
+        names = request.POST.getlist('name')
+        cell_ids = _batch_cell_ids(request)
+        hashes = request.POST.getlist('content_sha256')
+        contents = request.FILES.getlist('content')
+
+        if not names or \
+               not len(names) == len(cell_ids) == len(hashes) == len(contents):
+            raise APIBadRequest({'error': 'Expected equal number of name, '
+                                 'cell, content_sha256 and content'})
+
+        resource, created = UserResource.objects.get_or_create(
+            user=request.user,
+            name=request.POST.get('resource', 'melissi')
+            )
+
+        cells = Cell.objects.in_bulk(cell_ids)
+        sizes = {}
+        droplets = []
+        for index, (name, cell_id, content_sha256, content) in \
+                enumerate(zip(names, cell_ids, hashes, contents)):
+            if not name or not content_sha256:
+                raise APIBadRequest({'error': 'Missing name or content_sha256',
+                                     'index': index})
+
+            cell = cells[cell_id]
+            droplet = Droplet(name=name,
+                              owner=request.user,
+                              cell=cell,
+                              content=content,
+                              content_sha256=content_sha256)
+            droplet.resource = resource
+            droplet.defer_quota = True
+
+            stored.append(content_sha256)
+            try:
+                droplet.save()
+            except ValidationError, error:
+                raise APIBadRequest({'error': error.messages,
+                                     'index': index})
+
+            sizes[cell] = sizes.get(cell, 0) + content.size
+            droplets.append(droplet)
+
+        for cell, size in sizes.iteritems():
+            UserProfile.add_quota(cell.owner_id, cell, size)
+
+        return droplets
+
+class UploadSessionHandler(BaseHandler):
+    """
+    Resumable uploads.
+
+    Create a session, PUT the content in chunks with an 'offset'
+    query parameter and post the session id as 'upload' instead of
+    'content' to create a droplet or a revision. Reading the session
+    tells how much was received, to resume from there.
+    """
+    allowed_methods = ('GET', 'POST', 'PUT', 'DELETE')
+    model = UploadSession
+    fields = ('id', 'size', 'created', 'updated')
+
+    @add_server_timestamp
+    @watchdog_notfound
+    def read(self, request, upload_id):
+        return UploadSession.objects.get(pk=upload_id, owner=request.user)
+
+    @add_server_timestamp
+    @transaction.commit_on_success()
+    def create(self, request):
+        return UploadSession.objects.create(owner=request.user)
+
+    @add_server_timestamp
+    @watchdog_notfound
+    @transaction.commit_on_success()
+    def update(self, request, upload_id):
+        session = UploadSession.objects.get(pk=upload_id, owner=request.user)
+        try:
+            offset = int(request.GET.get('offset', session.size))
+            session.write(offset, request.raw_post_data)
+        except ValueError:
+            raise APIBadRequest({'error': 'Wrong offset',
+                                 'size': session.size})
+
+        return session
+
+    @watchdog_notfound
+    @transaction.commit_on_success()
+    def delete(self, request, upload_id):
+        UploadSession.objects.get(pk=upload_id, owner=request.user).delete()
+
+        return rc.DELETED
+
 class CellCreateForm(ResourceForm):
     class Meta:
         model = Cell
@@ -442,7 +637,7 @@ class CellHandler(BaseHandler):
     @watchdog_notfound
     @check_read_permission
     def read(self, request, cell_id):
-        cell = Cell.objects.get(pk=cell_id)
+        cell = Cell.objects.select_related('owner').get(pk=cell_id)
         try:
             share = cell.share_set.get(user=request.user)
             # change cell.name and cell.parent according to share
@@ -557,8 +752,7 @@ class CellShareHandler(BaseHandler):
     @check_read_permission
     def read(self, request, cell_id):
         cell = Cell.objects.get(pk=cell_id)
-        shares = Share.objects.filter(Q(cell__in=cell.get_ancestors()) |\
-                                      Q(cell = cell))
+        shares = cell.get_shares()
         return shares
 
     @add_server_timestamp
@@ -591,10 +785,7 @@ class CellShareHandler(BaseHandler):
     def delete(self, request, cell_id, username=None):
         cell = Cell.objects.get(pk=cell_id)
         try:
-            share_root = Share.objects.filter(
-                Q(cell__in = cell.get_ancestors()) |\
-                Q(cell = cell)
-                )[0].cell
+            share_root = cell.get_shares()[0].cell
         except IndexError:
             # cell is not shared, nothing to delete
             raise APIBadRequest("Cell or Tree not shared")
@@ -628,7 +819,26 @@ class StatusHandler(BaseHandler):
     allowed_methods = ('GET', )
 
     @add_server_timestamp
-    def read(self, request, timestamp=None):
+    def read(self, request, timestamp=None, cursor=None, wait=False):
+        if wait:
+            return self._wait_changes(request, int(cursor),
+                                      self._timeout(request))
+
+        # latest journal entry, before looking at anything else so
+        # that changes happening meanwhile are not lost
+        latest = Change.latest_id()
+
+        if cursor is not None:
+            status = self._read_changes(request, int(cursor), latest)
+            status['cursor'] = latest
+            return status
+
+        # /status/all/
+        if timestamp == 0:
+            status = self._read_all(request)
+            status['cursor'] = latest
+            return status
+
         # note that the default timestamp is 24hours
         if not timestamp:
             timestamp = datetime.now() - timedelta(days=1)
@@ -640,59 +850,211 @@ class StatusHandler(BaseHandler):
                 raise APIBadRequest({'timestamp': 'Bad timestamp format'})
 
 
-        status_droplets = []
-        status_cells = []
+        shares = Share.objects.filter(user=request.user).\
+                 select_related('cell', 'parent')
 
-        shares = Share.objects.filter(user=request.user)
-        owned_cells = Cell.objects.filter(owner=request.user)
+        # owned cells and droplets after timestamp
+        cells = Q(owner=request.user, updated__gte=timestamp)
+        droplets = Q(cell__owner=request.user, updated__gte=timestamp)
 
+        for share in shares:
+            if share.updated >= timestamp:
+                # this is a new share, force add everything
+                cells |= share.cell.subtree_q()
+                droplets |= share.cell.subtree_q('cell')
 
-        # add owned droplets after timestamp
-        map(lambda x: status_droplets.append(x),
-            Droplet.objects.filter(cell__in = owned_cells,
-                                   updated__gte = timestamp)
-            )
+            else:
+                # this is an old share, add only new stuff
+                cells |= share.cell.subtree_q() & Q(updated__gte=timestamp)
+                droplets |= share.cell.subtree_q('cell') & \
+                            Q(updated__gte=timestamp)
+
+        status_cells = list(Cell.objects.select_related('owner').filter(cells))
+        status_droplets = list(Droplet.objects.\
+                               select_related('cell__owner', 'owner').\
+                               filter(droplets))
+
+        # shared cells appear with the name and parent of the share
+        shares = dict((share.cell_id, share) for share in shares)
+        for cell in status_cells:
+            if cell.id in shares:
+                cell.name = shares[cell.id].name
+                cell.parent = shares[cell.id].parent
+
+        return {'cells': status_cells, 'droplets': status_droplets,
+                'cursor': latest }
+
+    def _read_all(self, request):
+        """
+        Return every cell and droplet of the user, ordered by id and
+        as iterators, so that the reply is streamed.
 
-        # add owned cells after timestamp
-        map(lambda x: status_cells.append(x),
-            owned_cells.filter(updated__gte=timestamp)
-            )
+        With ?limit=N at most N cells and droplets are returned,
+        along with a 'next' token. ?after=<next> continues from there.
+        """
+        shares = Share.objects.filter(user=request.user).\
+                 select_related('cell', 'parent')
 
-        # now add shares
+        cells = Q(owner=request.user)
+        droplets = Q(cell__owner=request.user)
         for share in shares:
-            cell = share.cell
-            cell.name = share.name
-            cell.parent = share.parent
+            cells |= share.cell.subtree_q()
+            droplets |= share.cell.subtree_q('cell')
 
-            if share.updated >= timestamp:
-                # this is a new share, force add everything
-                map(lambda x: status_cells.append(x),
-                    share.cell.get_descendants())
-                status_cells.append(cell)
+        cells = Cell.objects.select_related('owner').filter(cells).order_by('id')
+        droplets = Droplet.objects.select_related('cell__owner', 'owner').\
+                   filter(droplets).order_by('id')
+
+        # cells come first, then droplets. The token is the kind and
+        # id of the last item sent
+        after = request.GET.get('after', 'c0')
+        try:
+            limit = int(request.GET.get('limit', 0))
+            kind, last = after[:1], int(after[1:])
+        except ValueError:
+            raise APIBadRequest({'after': 'Bad continuation token'})
+
+        if kind == 'c':
+            cells = cells.filter(pk__gt=last)
+        elif kind == 'd':
+            cells = cells.none()
+            droplets = droplets.filter(pk__gt=last)
+        else:
+            raise APIBadRequest({'after': 'Bad continuation token'})
 
-                map(lambda x: status_droplets.append(x),
-                    Droplet.objects.filter(
-                        Q(cell__in = share.cell.get_descendants()) |\
-                        Q(cell = cell)
-                        )
-                    )
+        next = None
+        if limit > 0:
+            ids = list(cells.values_list('id', flat=True)[:limit])
+            if len(ids) == limit:
+                cells = cells.filter(pk__lte=ids[-1])
+                droplets = droplets.none()
+                next = 'c%d' % ids[-1]
 
             else:
-                # this is an old share, add only new stuff
-                map(lambda x: status_cells.append(x),
-                    share.cell.get_descendants().filter(updated__gte=timestamp)
-                    )
-                if share.cell.updated >= timestamp:
-                    status_cells.append(cell)
-
-                map(lambda x: status_droplets.append(x),
-                    Droplet.objects.filter(
-                        Q(cell__in = share.cell.get_descendants()) |\
-                        Q(cell = cell)
-                        ).filter(updated__gte=timestamp)
-                    )
-
-        return {'cells': status_cells, 'droplets': status_droplets }
+                limit -= len(ids)
+                ids = list(droplets.values_list('id', flat=True)[:limit])
+                if len(ids) == limit:
+                    droplets = droplets.filter(pk__lte=ids[-1])
+                    next = 'd%d' % ids[-1]
+
+        shares = dict((share.cell_id, share) for share in shares)
+        def status_cells():
+            for cell in cells.iterator():
+                # shared cells appear with the name and parent of the share
+                if cell.id in shares:
+                    cell.name = shares[cell.id].name
+                    cell.parent = shares[cell.id].parent
+                yield cell
+
+        return {'cells': status_cells(), 'droplets': droplets, 'next': next}
+
+    def _timeout(self, request):
+        """
+        Return the ?timeout= seconds of request, at most
+        MELISSI_LONGPOLL_TIMEOUT
+        """
+        max_timeout = getattr(settings, 'MELISSI_LONGPOLL_TIMEOUT', 60)
+        try:
+            timeout = float(request.GET.get('timeout', max_timeout))
+        except ValueError:
+            timeout = None
+        if timeout is None or math.isnan(timeout) or math.isinf(timeout):
+            raise APIBadRequest({'timeout': 'Bad timeout'})
+
+        return max(0, min(timeout, max_timeout))
+
+    @transaction.commit_manually()
+    def _wait_changes(self, request, cursor, timeout):
+        """
+        Like _read_changes, but block until there are changes or
+        timeout seconds pass.
+
+        Waiting happens on the notification bus, the database is only
+        queried again when the bus signals a change.
+        """
+        deadline = time.time() + timeout
+        while True:
+            token = notify.token(request.user.id)
+            try:
+                latest = Change.latest_id()
+                status = self._read_changes(request, cursor, latest)
+            finally:
+                # end the transaction so that the next round sees new
+                # data, nothing was written
+                transaction.rollback()
+
+            left = deadline - time.time()
+            if status['cells'] or status['droplets'] or status['unshared'] \
+                   or left <= 0:
+                status['cursor'] = latest
+                return status
+
+            notify.wait(request.user.id, token, left)
+
+    def _read_changes(self, request, cursor, latest):
+        """
+        Return cells and droplets with journal entries after cursor,
+        and the ids of cells unshared from the user since
+        """
+        shares = Share.objects.filter(user=request.user).\
+                 select_related('cell', 'parent')
+
+        # entries in cells owned by the user or in trees shared with him
+        visible = Q(cell__owner=request.user)
+        for share in shares:
+            visible |= share.cell.subtree_q('cell')
+
+        # subtree entries above a share reach into it too
+        reaching = visible
+        for share in shares:
+            reaching |= Q(cell__tree_id=share.cell.tree_id,
+                          cell__lft__lt=share.cell.lft,
+                          cell__rght__gt=share.cell.rght)
+
+        entries = Change.objects.filter(sequence__gt=cursor,
+                                        sequence__lte=latest)
+        changes = entries.filter(visible, unshared=False)
+
+        status_cells = Q(pk__in=set(changes.filter(droplet__isnull=True).\
+                                    values_list('cell', flat=True)))
+        status_droplets = Q(pk__in=set(changes.filter(droplet__isnull=False).\
+                                       values_list('droplet', flat=True)))
+
+        for change in entries.filter(reaching,
+                                     Q(user__isnull=True) |\
+                                     Q(user=request.user),
+                                     subtree=True, unshared=False).\
+                                     select_related('cell'):
+            roots = [change.cell]
+            if change.cell.owner_id != request.user.id and \
+                   not [share for share in shares
+                        if change.cell.is_descendant_of(share.cell,
+                                                        include_self=True)]:
+                # only the shared parts of the subtree
+                roots = [share.cell for share in shares
+                         if share.cell.is_descendant_of(change.cell)]
+
+            for root in roots:
+                status_cells |= root.subtree_q()
+                status_droplets |= root.subtree_q('cell')
+
+        cells = list(Cell.objects.select_related('owner').filter(status_cells))
+        droplets = list(Droplet.objects.select_related('cell__owner', 'owner').\
+                        filter(status_droplets))
+
+        # shared cells appear with the name and parent of the share
+        shares = dict((share.cell_id, share) for share in shares)
+        for cell in cells:
+            if cell.id in shares:
+                cell.name = shares[cell.id].name
+                cell.parent = shares[cell.id].parent
+
+        # cells no longer shared with the user, unless shared again
+        unshared = set(entries.filter(user=request.user, unshared=True).\
+                       values_list('cell', flat=True)) - set(shares)
+
+        return {'cells': cells, 'droplets': droplets,
+                'unshared': sorted(unshared)}
 
 class ResourceHandler(BaseHandler):
     model = UserResource
@@ -1,19 +1,21 @@
 from django.conf.urls.defaults import *
-from piston.authentication import HttpBasicAuthentication
+from authentication import CachedHttpBasicAuthentication
 from resource import Resource
 
 from apihandlers import CellHandler, CellShareHandler, DropletHandler,\
-     DropletRevisionDataHandler, DropletRevisionHandler, UserHandler,\
-     StatusHandler
+     DropletBatchHandler, DropletRevisionDataHandler, DropletRevisionHandler,\
+     UserHandler, StatusHandler, UploadSessionHandler
 
-basic_auth = HttpBasicAuthentication(realm='melissi')
+basic_auth = CachedHttpBasicAuthentication(realm='melissi')
 cell_handler = Resource(CellHandler, authentication=basic_auth)
 cell_share_handler = Resource(CellShareHandler, authentication=basic_auth)
 droplet_handler = Resource(DropletHandler, authentication=basic_auth)
+droplet_batch_handler = Resource(DropletBatchHandler, authentication=basic_auth)
 droplet_revision_data_handler = Resource(DropletRevisionDataHandler, authentication=basic_auth)
 droplet_revision_handler = Resource(DropletRevisionHandler, authentication=basic_auth)
 user_handler = Resource(UserHandler, authentication=basic_auth)
-status_handler = Resource(StatusHandler, authentication=basic_auth)
+upload_handler = Resource(UploadSessionHandler, authentication=basic_auth, raw=True)
+status_handler = Resource(StatusHandler, authentication=basic_auth, stream=True)
 
 urlpatterns = patterns(
     '',
@@ -23,6 +25,7 @@ urlpatterns = patterns(
     (r'^cell/$', cell_handler),
 
     (r'^droplet/$', droplet_handler),
+    (r'^droplet/batch/$', droplet_batch_handler),
     (r'^droplet/(?P<droplet_id>\d+)/$', droplet_handler),
 
     (r'^droplet/(?P<droplet_id>\d+)/revision/$',
@@ -33,17 +36,30 @@ urlpatterns = patterns(
      droplet_revision_data_handler,  {'type':'content'}),
     (r'^droplet/(?P<droplet_id>\d+)/revision/(?P<revision_number>\d+)/patch/$',
      droplet_revision_data_handler,  {'type':'patch'}),
+    (r'^droplet/(?P<droplet_id>\d+)/revision/(?P<revision_number>\d+)/signature/$',
+     droplet_revision_data_handler,  {'type':'signature'}),
+    (r'^droplet/(?P<droplet_id>\d+)/revision/(?P<revision_number>\d+)/delta/$',
+     droplet_revision_data_handler,  {'type':'delta'}),
     (r'^droplet/(?P<droplet_id>\d+)/revision/latest/content/$',
      droplet_revision_data_handler, {'type':'content'}),
     (r'^droplet/(?P<droplet_id>\d+)/revision/latest/patch/$',
      droplet_revision_data_handler, {'type':'patch'}),
+    (r'^droplet/(?P<droplet_id>\d+)/revision/latest/signature/$',
+     droplet_revision_data_handler, {'type':'signature'}),
+    (r'^droplet/(?P<droplet_id>\d+)/revision/latest/delta/$',
+     droplet_revision_data_handler, {'type':'delta'}),
 
     (r'^status/all/$', status_handler, {'timestamp': 0}),
     (r'^status/after/(?P<timestamp>\d+\.?\d*)/$', status_handler),
+    (r'^status/changes/(?P<cursor>\d+)/$', status_handler),
+    (r'^status/wait/(?P<cursor>\d+)/$', status_handler, {'wait': True}),
     (r'^status/$', status_handler),
 
     (r'^user/(?P<user_id>\d+)/$', user_handler),
     (r'^user/$', user_handler),
 
+    (r'^upload/(?P<upload_id>\d+)/$', upload_handler),
+    (r'^upload/$', upload_handler),
+
 
     )
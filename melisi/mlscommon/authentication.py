@@ -0,0 +1,52 @@
+"""
+Authentication for the API resources.
+
+Clients send their credentials with every request, status polls
+included. Checking them costs a full password hash, so verified
+credentials are remembered in the cache for a short while.
+"""
+import hmac
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+from piston.authentication import HttpBasicAuthentication
+
+class CachedHttpBasicAuthentication(HttpBasicAuthentication):
+    """
+    HttpBasicAuthentication that caches verified Authorization
+    headers for MELISSI_AUTH_CACHE_TIMEOUT seconds.
+
+    The cache key is a keyed hash of the header, so passwords never
+    reach the cache. Entries store the user's password hash and stop
+    matching as soon as the password changes.
+    """
+    def _cache_key(self, auth_string):
+        return 'mls-auth-%s' % hmac.new(settings.SECRET_KEY, auth_string,
+                                        hashlib.sha256).hexdigest()
+
+    def is_authenticated(self, request):
+        auth_string = request.META.get('HTTP_AUTHORIZATION', None)
+        if not auth_string:
+            return False
+
+        key = self._cache_key(auth_string)
+        cached = cache.get(key)
+        if cached:
+            user_id, password = cached
+            try:
+                request.user = User.objects.get(pk=user_id, password=password)
+                return True
+            except User.DoesNotExist:
+                cache.delete(key)
+
+        if not super(CachedHttpBasicAuthentication,
+                     self).is_authenticated(request):
+            return False
+
+        cache.set(key, (request.user.id, request.user.password),
+                  getattr(settings, 'MELISSI_AUTH_CACHE_TIMEOUT', 300))
+
+        return True
@@ -1,9 +1,13 @@
 import hashlib
 import os
+import re
 import mimetypes
 
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.utils.http import http_date, parse_etags, quote_etag
+from django.views.static import was_modified_since
 from django.core.servers.basehttp import FileWrapper
+from django.core.files import File
 from django.conf import settings
 
 import librsync
@@ -11,8 +15,14 @@ import librsync
 def calculate_sha256(file_object):
     """ Return the sha256 hexdigest of file_object.
 
-    file_object is a Django File Object
+    file_object is a Django File Object. Uploaded files already hashed
+    by uploadhandlers are not read again.
     """
+    sha256 = getattr(file_object, 'sha256', None) or \
+             getattr(getattr(file_object, '_file', None), 'sha256', None)
+    if sha256:
+        return sha256
+
     h = hashlib.sha256()
     for chunk in file_object.chunks():
         h.update(chunk)
@@ -42,16 +52,167 @@ def patch_file(source, delta):
     delta.seek(0)
     return f
 
-def basic_sendfile(fileobj, download_name=None):
+def signature_file(source):
+    """ Return the librsync signature of source
+    """
+    f = librsync.SignatureFile(source)
+    source.seek(0)
+    return f
+
+def delta_file(signature, target):
+    """ Return the librsync delta that turns the file with signature
+    into target
+    """
+    f = librsync.DeltaFile(signature, target)
+    target.seek(0)
+    return f
+
+def sized_file(fileobj, name=None):
+    """ Return fileobj as a django.core.files.File with its size set.
+
+    Used for the results of librsync which do not live under a file
+    name Django can stat.
+    """
+    fileobj.seek(0, os.SEEK_END)
+    f = File(fileobj, name=name)
+    f.size = fileobj.tell()
+    fileobj.seek(0)
+    return f
+
+def _not_modified(request, path, etag):
+    """ Return True if the client already has the file at path
+    """
+    if request is None:
+        return False
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        return if_none_match.strip() == '*' or \
+               bool(etag and etag in parse_etags(if_none_match))
+
+    return not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'),
+                                  os.path.getmtime(path),
+                                  os.path.getsize(path))
+
+def _byte_range(request, size, etag):
+    """ Return the (first, last) byte of the range requested, or None
+    to send the whole file. Raise ValueError when the range cannot be
+    satisfied.
+
+    Only single ranges are supported, other requests get the whole
+    file as HTTP allows.
+    """
+    if request is None or not request.META.get('HTTP_RANGE'):
+        return None
+
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and not (etag and parse_etags(if_range) == [etag]):
+        # client copy changed, send it all
+        return None
+
+    match = re.match(r'^bytes=(\d*)-(\d*)$', request.META['HTTP_RANGE'].strip())
+    if not match or match.groups() == ('', ''):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        # last bytes of the file, none of an empty one
+        if not int(last) or not size:
+            raise ValueError("Unsatisfiable range")
+        return max(size - int(last), 0), size - 1
+
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size:
+        raise ValueError("Unsatisfiable range")
+    if last < first:
+        return None
+
+    return first, last
+
+def _file_range(fileobj, length, chunk_size=64 * 2 ** 10):
+    """ Yield length bytes of fileobj and close it
+    """
+    try:
+        while length > 0:
+            data = fileobj.read(min(chunk_size, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fileobj.close()
+
+def _accepts_gzip(request):
+    return request is not None and \
+           bool(re.search(r'\bgzip\b',
+                          request.META.get('HTTP_ACCEPT_ENCODING', '')))
+
+def _cache_headers(response, path, etag):
+    response['Last-Modified'] = http_date(os.path.getmtime(path))
+    response['Accept-Ranges'] = 'bytes'
+    if etag:
+        response['ETag'] = quote_etag(etag)
+
+    return response
+
+def basic_sendfile(fileobj, download_name=None, request=None, etag=None):
     if not os.path.exists(fileobj.path):
         raise Http404
 
-    wrapper = FileWrapper(open(fileobj.path,"r"))
+    # the stored gzip stream of compressed files is a variant with an
+    # ETag of its own, ranges are always of the identity bytes
+    encoded = None
+    if _accepts_gzip(request) and not request.META.get('HTTP_RANGE') and \
+           getattr(fileobj.storage, 'compressed', False):
+        encoded = fileobj.storage.open_encoded(fileobj.name)
+        if encoded and etag:
+            etag = '%s-gzip' % etag
+
+    if _not_modified(request, fileobj.path, etag):
+        if encoded:
+            encoded[0].close()
+        return _cache_headers(HttpResponseNotModified(), fileobj.path, etag)
+
+    # through the storage, chunked and compressed files are not
+    # stored the way they are read
+    size = fileobj.storage.size(fileobj.name)
+    try:
+        byte_range = _byte_range(request, size, etag)
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+        return response
+
+    content_type = mimetypes.guess_type(download_name or fileobj.path)[0]
+    if byte_range:
+        first, last = byte_range
+        f = fileobj.storage.open(fileobj.name, "rb")
+        f.seek(first)
+        response = HttpResponse(_file_range(f, last - first + 1),
+                                content_type=content_type,
+                                status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+        response['Content-Length'] = last - first + 1
+
+    elif encoded:
+        # send compressed files as they are stored
+        f, length = encoded
+        response = HttpResponse(_file_range(f, length),
+                                content_type=content_type)
+        response['Content-Encoding'] = 'gzip'
+        response['Content-Length'] = length
+
+    else:
+        wrapper = FileWrapper(fileobj.storage.open(fileobj.name, "rb"))
+        response = HttpResponse(wrapper, content_type=content_type)
+        response['Content-Length'] = size
+
+    if getattr(fileobj.storage, 'compressed', False):
+        response['Vary'] = 'Accept-Encoding'
 
-    content_type = mimetypes.guess_type(fileobj.path)[0]
-    response = HttpResponse(wrapper, content_type=content_type)
-    response['Content-Length'] = os.path.getsize(fileobj.path)
     response['Content-Type'] = content_type or 'application/octet-stream'
+    _cache_headers(response, fileobj.path, etag)
 
     if download_name:
         response['Content-Disposition'] = "attachment; filename=%s"%download_name
@@ -62,14 +223,25 @@ def basic_sendfile(fileobj, download_name=None):
 
     return response
 
-def adv_sendfile(send_type, fileobj, download_name=None):
+def adv_sendfile(send_type, fileobj, download_name=None, request=None,
+                 etag=None):
+    if getattr(fileobj.storage, 'chunked', False) or \
+           getattr(fileobj.storage, 'compressed', False):
+        # the web server cannot reassemble chunks or inflate files
+        return basic_sendfile(fileobj, download_name, request, etag)
+
     if not os.path.exists(fileobj.path):
         raise Http404
 
-    content_type = mimetypes.guess_type(fileobj.path)[0]
+    if _not_modified(request, fileobj.path, etag):
+        return _cache_headers(HttpResponseNotModified(), fileobj.path, etag)
+
+    content_type = mimetypes.guess_type(download_name or fileobj.path)[0]
     response = HttpResponse('', content_type=content_type)
     response['Content-Length'] = os.path.getsize(fileobj.path)
     response['Content-Type'] = content_type or 'application/octet-stream'
+    # ranges are served by the web server
+    _cache_headers(response, fileobj.path, etag)
 
     if send_type == 'sendfile':
         response['X-Sendfile'] = fileobj.path
@@ -90,11 +262,12 @@ def adv_sendfile(send_type, fileobj, download_name=None):
 
     return response
 
-def x_sendfile(fileobj, download_name=None):
-    return adv_sendfile('sendfile', fileobj, download_name)
+def x_sendfile(fileobj, download_name=None, request=None, etag=None):
+    return adv_sendfile('sendfile', fileobj, download_name, request, etag)
 
-def accel_sendfile(fileobj, download_name=None):
-    return adv_sendfile('accel-redirect', fileobj, download_name)
+def accel_sendfile(fileobj, download_name=None, request=None, etag=None):
+    return adv_sendfile('accel-redirect', fileobj, download_name, request,
+                        etag)
 
 if getattr(settings, 'SENDFILE', False) == 'sendfile':
     sendfile = x_sendfile
@@ -0,0 +1,76 @@
+"""
+JSON emitter able to stream large replies.
+
+Resources created with stream=True render through stream_render:
+generators and querysets found in the reply are written element by
+element, so the full reply is never built in memory.
+"""
+import types
+
+from django.db.models.query import QuerySet
+from django.http import HttpResponse
+from django.utils import simplejson
+from django.core.serializers.json import DateTimeAwareJSONEncoder
+
+from piston.emitters import Emitter, JSONEmitter
+from piston.utils import HttpStatusCode
+from piston.validate_jsonp import is_valid_jsonp_callback_value
+
+class StreamingJSONEmitter(JSONEmitter):
+    def stream_render(self, request):
+        # errors must be raised before the response starts, the
+        # returned generator runs after piston has returned
+        if isinstance(self.data, HttpResponse):
+            raise HttpStatusCode(self.data)
+
+        return self._stream(request.GET.get('callback', None))
+
+    def _stream(self, callback):
+        if callback and is_valid_jsonp_callback_value(callback):
+            yield '%s(' % callback
+            for chunk in self._render(self.data):
+                yield chunk
+            yield ')'
+
+        else:
+            for chunk in self._render(self.data):
+                yield chunk
+
+    def _dumps(self, data):
+        return simplejson.dumps(data,
+                                cls=DateTimeAwareJSONEncoder,
+                                ensure_ascii=False)
+
+    def _construct(self, data):
+        """ Serialize data respecting handler fields, like construct
+        """
+        return JSONEmitter(data, self.typemapper, self.handler,
+                           self.fields, self.anonymous).construct()
+
+    def _render(self, data):
+        if isinstance(data, dict):
+            yield '{'
+            for i, (key, value) in enumerate(data.iteritems()):
+                if i:
+                    yield ', '
+                yield '%s: ' % self._dumps(key)
+                for chunk in self._render(value):
+                    yield chunk
+            yield '}'
+
+        elif isinstance(data, (types.GeneratorType, QuerySet)):
+            if isinstance(data, QuerySet):
+                # do not fill the queryset cache
+                data = data.iterator()
+
+            yield '['
+            for i, item in enumerate(data):
+                if i:
+                    yield ', '
+                yield self._dumps(self._construct(item))
+            yield ']'
+
+        else:
+            yield self._dumps(self._construct(data))
+
+Emitter.register('json', StreamingJSONEmitter, 'application/json; charset=utf-8')
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Split whole files of the chunked blob store into content defined
+# chunks
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mlscommon.models import Blob, Chunk
+from mlscommon.storage import blob_storage
+
+
+class Command(BaseCommand):
+    help = "Replace whole blobs of the chunked blob store by manifests " \
+           "of shared chunks"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch',
+                    type='int',
+                    dest='batch',
+                    default=1000,
+                    help='Rows handled at once (default 1000)'),
+        )
+
+    def handle(self, *args, **options):
+        if not getattr(blob_storage, 'chunked', False):
+            raise CommandError("MELISSI_CHUNK_STORE is not enabled")
+
+        chunked = 0
+        last_pk = 0
+        while True:
+            blobs = list(Blob.objects.filter(pk__gt=last_pk, refcount__gt=0).\
+                         order_by('pk').values_list('pk', 'sha256')\
+                         [:options['batch']])
+            if not blobs:
+                break
+
+            for pk, sha256 in blobs:
+                if Chunk.chunk_blob(sha256):
+                    chunked += 1
+
+            last_pk = blobs[-1][0]
+
+        self.stdout.write("Chunked %d blobs\n" % chunked)
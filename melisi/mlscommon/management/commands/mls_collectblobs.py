@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Remove content blobs that are no longer referenced by any revision
+
+from datetime import timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from mlscommon.models import Blob
+
+
+class Command(BaseCommand):
+    help = "Delete unreferenced blobs from the blob store"
+    option_list = BaseCommand.option_list + (
+        make_option('--grace',
+                    type='int',
+                    dest='grace',
+                    default=60,
+                    help='Minutes an unreferenced blob is kept before '
+                    'deletion (default 60)'),
+        )
+
+    def handle(self, *args, **options):
+        reclaimed = Blob.collect_garbage(timedelta(minutes=options['grace']))
+        self.stdout.write("Reclaimed %d bytes\n" % reclaimed)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Delete droplet revisions outside the retention policy
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from mlscommon.models import Droplet, DropletRevision
+from mlscommon import notify
+
+
+class Command(BaseCommand):
+    help = "Delete old droplet revisions according to the retention " \
+           "policy. Defaults come from the MELISSI_RETENTION_* settings"
+    option_list = BaseCommand.option_list + (
+        make_option('--last',
+                    type='int',
+                    dest='last',
+                    default=getattr(settings, 'MELISSI_RETENTION_LAST', None),
+                    help='Newest revisions always kept'),
+        make_option('--days',
+                    type='int',
+                    dest='days',
+                    default=getattr(settings, 'MELISSI_RETENTION_DAYS', 0),
+                    help='Days for which one revision per day is kept'),
+        make_option('--weeks',
+                    type='int',
+                    dest='weeks',
+                    default=getattr(settings, 'MELISSI_RETENTION_WEEKS', 0),
+                    help='Weeks for which one revision per week is kept'),
+        make_option('--max-bytes',
+                    type='int',
+                    dest='max_bytes',
+                    default=getattr(settings, 'MELISSI_RETENTION_BYTES', None),
+                    help='Most content bytes kept per droplet'),
+        make_option('--batch',
+                    type='int',
+                    dest='batch',
+                    default=1000,
+                    help='Droplets handled at once (default 1000)'),
+        )
+
+    def handle(self, *args, **options):
+        last = options['last']
+        if not last:
+            raise CommandError("No retention policy, set --last or "
+                               "MELISSI_RETENTION_LAST")
+
+        droplets = Droplet.objects.order_by('pk')
+        if options['max_bytes'] is None:
+            # revisions holds the latest number, which is never less
+            # than the number of revisions
+            droplets = droplets.filter(revisions__gt=last)
+
+        pruned = 0
+        last_pk = 0
+        while True:
+            batch = list(droplets.filter(pk__gt=last_pk)[:options['batch']])
+            if not batch:
+                break
+
+            with transaction.commit_on_success():
+                expired = []
+                for droplet in batch:
+                    expired.extend(droplet.expired_revisions(
+                        last, options['days'], options['weeks'],
+                        options['max_bytes']))
+
+                # one delete for the batch, signals keep quota, blob
+                # references and reverse deltas right
+                if expired:
+                    DropletRevision.objects.filter(pk__in=expired).delete()
+            notify.flush()
+
+            pruned += len(expired)
+            last_pk = batch[-1].pk
+
+        self.stdout.write("Deleted %d revisions\n" % pruned)
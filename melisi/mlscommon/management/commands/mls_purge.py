@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Purge old deleted cells and droplets and remove orphaned files
+# from the store
+
+import os
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mlscommon.models import Cell, CellRevision, Droplet, DropletRevision, \
+     UploadSession, Blob
+from mlscommon import notify
+
+# directories of the store managed by their own models
+MANAGED_DIRECTORIES = ('blobs', 'chunks', 'deltacache', 'manifests', 'notify',
+                       'signatures', 'uploads')
+
+
+class Command(BaseCommand):
+    help = "Purge deleted cells and droplets older than the retention " \
+           "period and remove orphaned files from the store"
+    option_list = BaseCommand.option_list + (
+        make_option('--days',
+                    type='int',
+                    dest='days',
+                    default=30,
+                    help='Days deleted cells and droplets are kept '
+                    '(default 30)'),
+        make_option('--upload-hours',
+                    type='int',
+                    dest='upload_hours',
+                    default=24,
+                    help='Hours an untouched upload session is kept '
+                    '(default 24)'),
+        make_option('--delta-days',
+                    type='int',
+                    dest='delta_days',
+                    default=7,
+                    help='Days a cached delta is kept since it was last '
+                    'used (default 7)'),
+        make_option('--grace',
+                    type='int',
+                    dest='grace',
+                    default=60,
+                    help='Minutes an unreferenced file is kept before '
+                    'deletion (default 60)'),
+        make_option('--batch',
+                    type='int',
+                    dest='batch',
+                    default=1000,
+                    help='Rows or files handled at once (default 1000)'),
+        )
+
+    def handle(self, *args, **options):
+        self.batch = options['batch']
+        cutoff = datetime.now() - timedelta(days=options['days'])
+        grace = timedelta(minutes=options['grace'])
+
+        # droplets first, so deleting cells does not cascade over
+        # whole subtrees at once
+        droplets = self.purge_droplets(cutoff)
+        cells = self.purge_cells(cutoff)
+        sessions, reclaimed = self.purge_uploads(
+            datetime.now() - timedelta(hours=options['upload_hours']))
+        reclaimed += self.remove_orphans(datetime.now() - grace)
+        reclaimed += self.expire_deltas(
+            datetime.now() - timedelta(days=options['delta_days']))
+        reclaimed += Blob.collect_garbage(grace)
+
+        self.stdout.write("Purged %d droplets, %d cells and %d upload sessions\n" %\
+                          (droplets, cells, sessions))
+        self.stdout.write("Reclaimed %d bytes\n" % reclaimed)
+
+    def _batches(self, queryset):
+        """
+        Yield lists of primary keys of queryset, at most batch long.
+        Rows are expected to leave queryset once handled.
+        """
+        while True:
+            pks = list(queryset.values_list('pk', flat=True)[:self.batch])
+            if not pks:
+                return
+            yield pks
+
+    def purge_droplets(self, cutoff):
+        purged = 0
+        for pks in self._batches(Droplet.objects.filter(deleted=True,
+                                                        updated__lt=cutoff)):
+            with transaction.commit_on_success():
+                Droplet.objects.filter(pk__in=pks).delete()
+            notify.flush()
+            purged += len(pks)
+
+        return purged
+
+    def purge_cells(self, cutoff):
+        purged = 0
+        # only the top of deleted subtrees, descendants go with them
+        cells = Cell.objects.filter(deleted=True, updated__lt=cutoff).\
+                exclude(parent__deleted=True)
+        for pks in self._batches(cells):
+            for cell in Cell.objects.filter(pk__in=pks):
+                with transaction.commit_on_success():
+                    purged += cell.get_descendant_count() + 1
+
+                    # history of cells and droplets that moved out of
+                    # the subtree survives, without the old place
+                    CellRevision.objects.filter(cell.subtree_q('parent')).\
+                        exclude(cell.subtree_q('cell')).update(parent=None)
+                    DropletRevision.objects.filter(cell.subtree_q('cell')).\
+                        exclude(cell.subtree_q('droplet__cell')).\
+                        update(cell=None)
+
+                    cell.delete()
+                notify.flush()
+
+        return purged
+
+    def purge_uploads(self, cutoff):
+        purged = reclaimed = 0
+        for pks in self._batches(UploadSession.objects.filter(updated__lt=cutoff)):
+            with transaction.commit_on_success():
+                for session in UploadSession.objects.filter(pk__in=pks):
+                    reclaimed += session.size
+                    session.delete()
+            purged += len(pks)
+
+        return purged, reclaimed
+
+    def _referenced(self, names):
+        """ Return the subset of names used by any droplet or revision
+        """
+        referenced = set()
+        # content stored before the blob store is still under
+        # legacy names
+        for model, field in ((Droplet, 'content'),
+                             (Droplet, 'patch'),
+                             (DropletRevision, 'content'),
+                             (DropletRevision, 'patch'),
+                             (DropletRevision, 'delta')):
+            referenced.update(model.objects.filter(**{field + '__in': names}).\
+                              values_list(field, flat=True))
+
+        return referenced
+
+    def _remove_unreferenced(self, names, cutoff):
+        reclaimed = 0
+        referenced = self._referenced(names)
+        for name in names:
+            if name in referenced:
+                continue
+
+            path = os.path.join(settings.MELISSI_STORE_LOCATION, name)
+            try:
+                stat = os.stat(path)
+                if datetime.fromtimestamp(stat.st_mtime) >= cutoff:
+                    # maybe an upload still being saved
+                    continue
+                os.remove(path)
+            except OSError:
+                continue
+
+            reclaimed += stat.st_size
+
+        return reclaimed
+
+    def remove_orphans(self, cutoff):
+        """
+        Remove files of the store no droplet or revision points to,
+        checking them against the database batch by batch
+        """
+        reclaimed = 0
+        location = settings.MELISSI_STORE_LOCATION
+        names = []
+        for directory, dirnames, filenames in os.walk(location):
+            if directory == location:
+                dirnames[:] = [d for d in dirnames
+                               if d not in MANAGED_DIRECTORIES]
+
+            for filename in filenames:
+                names.append(os.path.relpath(os.path.join(directory, filename),
+                                             location))
+                if len(names) >= self.batch:
+                    reclaimed += self._remove_unreferenced(names, cutoff)
+                    names = []
+
+        if names:
+            reclaimed += self._remove_unreferenced(names, cutoff)
+
+        return reclaimed
+
+    def expire_deltas(self, cutoff):
+        """
+        Remove cached deltas not used since cutoff
+        """
+        reclaimed = 0
+        location = os.path.join(settings.MELISSI_STORE_LOCATION, 'deltacache')
+        for directory, dirnames, filenames in os.walk(location):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                    if datetime.fromtimestamp(stat.st_mtime) >= cutoff:
+                        continue
+                    os.remove(path)
+                except OSError:
+                    continue
+
+                reclaimed += stat.st_size
+
+        return reclaimed
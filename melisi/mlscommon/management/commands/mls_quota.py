@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Recalculate user quotas from droplet revisions
+
+from django.core.management.base import BaseCommand
+
+from mlscommon.models import UserProfile
+
+
+class Command(BaseCommand):
+    help = "Recalculate personal and shared quota of all users"
+
+    def handle(self, *args, **options):
+        fixed = 0
+        for profile in UserProfile.objects.all():
+            personal_quota = profile.personal_quota
+            shared_quota = profile.shared_quota
+
+            profile.calculate_quota()
+            profile.calculate_shared_quota()
+
+            if (personal_quota, shared_quota) != \
+                   (profile.personal_quota, profile.shared_quota):
+                UserProfile.objects.filter(pk=profile.pk).\
+                    update(personal_quota=profile.personal_quota,
+                           shared_quota=profile.shared_quota)
+                fixed += 1
+
+        self.stdout.write("Fixed quota of %d users\n" % fixed)
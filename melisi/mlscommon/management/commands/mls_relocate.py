@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Move files of the store from the old flat layout into the sharded
+# layout
+
+import os
+import errno
+import shutil
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from mlscommon.models import Droplet, DropletRevision, Blob, \
+     calculate_upload_path, calculate_delta_path
+from mlscommon.storage import blob_storage, file_storage, \
+     calculate_blob_path, is_sharded
+from mlscommon.common import calculate_sha256
+
+
+class Command(BaseCommand):
+    help = "Move patches and deltas into the sharded store layout and " \
+           "content stored under legacy names into the blob store"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch',
+                    type='int',
+                    dest='batch',
+                    default=1000,
+                    help='Rows handled at once (default 1000)'),
+        )
+
+    def handle(self, *args, **options):
+        self.batch = options['batch']
+        self.moved = self.failed = 0
+
+        for model, fields in ((DropletRevision, ('content', 'patch', 'delta')),
+                              (Droplet, ('content', 'patch'))):
+            last_pk = 0
+            while True:
+                rows = list(model.objects.filter(pk__gt=last_pk).\
+                            order_by('pk')[:self.batch])
+                if not rows:
+                    break
+
+                # names renamed through other rows of the batch sharing
+                # the same file
+                self.renamed = set()
+                # files are only linked or copied to their new names
+                # until the rows naming them are committed
+                self.created = []
+                self.stored = []
+                self.obsolete = []
+                try:
+                    with transaction.commit_on_success():
+                        for row in rows:
+                            for field in fields:
+                                self.relocate(row, field)
+                except:
+                    # the rows still name the old files
+                    for path in self.created:
+                        os.remove(path)
+                    for sha256 in self.stored:
+                        Blob.add_unreferenced(sha256)
+                    raise
+
+                for name in self.obsolete:
+                    file_storage.delete(name)
+
+                last_pk = rows[-1].pk
+
+        self.stdout.write("Relocated %d files, %d failed\n" %\
+                          (self.moved, self.failed))
+
+    def _rename(self, field, old, new):
+        """ Point every droplet and revision using old at new
+        """
+        DropletRevision.objects.filter(**{field: old}).update(**{field: new})
+        if field != 'delta':
+            Droplet.objects.filter(**{field: old}).update(**{field: new})
+        self.renamed.add((field, old))
+
+    def relocate(self, row, field):
+        old = getattr(row, field).name
+        if not old or (field, old) in self.renamed:
+            return
+
+        if field == 'content':
+            self.relocate_content(row, old)
+            return
+
+        if is_sharded(old):
+            return
+
+        if not file_storage.exists(old):
+            self.stderr.write("Missing file %s\n" % old)
+            self.failed += 1
+            return
+
+        if field == 'patch':
+            name = calculate_upload_path(row, old)
+        else:
+            name = calculate_delta_path(row, old)
+        name = file_storage.get_available_name(name)
+
+        # same storage, the stored bytes move as they are
+        path = file_storage.path(name)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            os.link(file_storage.path(old), path)
+        except OSError:
+            shutil.copyfile(file_storage.path(old), path)
+        self.created.append(path)
+
+        self._rename(field, old, name)
+        self.obsolete.append(old)
+        self.moved += 1
+
+    def relocate_content(self, row, old):
+        if not row.content_sha256 or \
+               old == calculate_blob_path(row.content_sha256):
+            return
+
+        if not file_storage.exists(old):
+            self.stderr.write("Missing file %s\n" % old)
+            self.failed += 1
+            return
+
+        content = blob_storage.open(old, 'rb')
+        try:
+            if calculate_sha256(content) != row.content_sha256:
+                self.stderr.write("Hashes do not match for %s\n" % old)
+                self.failed += 1
+                return
+
+            content.seek(0)
+            name = blob_storage.save(calculate_blob_path(row.content_sha256),
+                                     content)
+            self.stored.append(row.content_sha256)
+        finally:
+            content.close()
+
+        # revisions in the blob store hold a reference each, droplets
+        # share the ones of their revisions
+        count = DropletRevision.objects.filter(content=old).count()
+        if count:
+            Blob.add_reference(row.content_sha256)
+            Blob.objects.filter(sha256=row.content_sha256).\
+                update(refcount=F('refcount') + count - 1)
+
+        self._rename('content', old, name)
+        self.obsolete.append(old)
+        self.moved += 1
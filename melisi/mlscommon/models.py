@@ -2,26 +2,80 @@ from django.db import models
 
 # Create your models here.
 from django.contrib.auth.models import User
-from django.core.files.storage import FileSystemStorage
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db.models.fields.files import FieldFile
 from django.core.validators import MinLengthValidator
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
-from django.db.models import Sum, Q
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Sum, Q, F
 from django.conf import settings
 from mptt.models import MPTTModel
 
+import os
 import hashlib
-from datetime import datetime
-from common import calculate_sha256
+from datetime import datetime, timedelta
+from common import calculate_sha256, patch_file, signature_file, delta_file,\
+     sized_file
+from storage import blob_storage, file_storage, calculate_blob_path,\
+     calculate_signature_path, calculate_delta_cache_path,\
+     calculate_sharded_path, calculate_chunk_path
+from uploadhandlers import StagedUploadedFile
+import notify
 
 def calculate_upload_path(instance, filename):
     if isinstance(instance, Droplet):
-        return "%s" % (instance.name)
+        if instance.pk is None:
+            # patches are stored under the droplet id, see Droplet.save
+            raise Exception("Cannot calculate upload path of unsaved droplet")
+        return calculate_sharded_path('patches', instance.pk,
+                                      instance.revisions)
     elif isinstance(instance, DropletRevision):
-        return "%s" % (instance.droplet.id)
+        return calculate_sharded_path('patches', instance.droplet_id,
+                                      instance.number)
     else:
         raise Exception("Cannot calculate upload path")
 
+def calculate_delta_path(instance, filename):
+    return calculate_sharded_path('deltas', instance.droplet_id,
+                                  instance.number)
+
+def calculate_content_path(instance, filename):
+    if not instance.content_sha256:
+        raise ValidationError("Cannot have content without content sha256")
+
+    return calculate_blob_path(instance.content_sha256)
+
+def verify_content(content, content_sha256, verified=None):
+    """
+    Raise ValidationError if content does not match content_sha256
+
+    Content already in the blob store under content_sha256 has been
+    verified before it got there and is not read again, neither is
+    stored content that still matches verified, the (name, sha256)
+    pair it was loaded with. Other content is read once, its digest
+    is kept on the file for later checks.
+    """
+    if content._committed and \
+           (content.name == calculate_blob_path(content_sha256) or
+            (content.name, content_sha256) == verified):
+        return
+
+    sha256 = getattr(content, 'sha256', None) or calculate_sha256(content)
+    content.sha256 = sha256
+
+    if str(content_sha256) != sha256:
+        raise ValidationError("Hashes do not match")
+
+def track_verified_content(sender, instance, **kwargs):
+    """
+    Remember the content of instances loaded from the database, it
+    was verified when saved
+    """
+    if instance.pk and instance.content_sha256:
+        instance._verified_content = (instance.content.name,
+                                      instance.content_sha256)
+
 class PatchValidator(object):
     def __call__(self, value):
         if not value.read(4).encode('HEX') == '72730236':
@@ -48,14 +102,11 @@ class Cell(MPTTModel):
     @property
     def pid(self):
         """ return parent_id """
-        if self.parent:
-            return self.parent.id
-        else:
-            return False
+        return self.parent_id or False
 
     @classmethod
-    def _first_revision_creator(self, sender, instance, **kwargs):
-        if instance.cellrevision_set.count() == 0:
+    def _first_revision_creator(self, sender, instance, created, **kwargs):
+        if created:
             # create first revision
             revision = CellRevision(cell=instance,
                                     name = instance.name,
@@ -80,20 +131,89 @@ class Cell(MPTTModel):
         # if parent set owner to parent.owner
         if self.parent:
             self.owner = self.parent.owner
-        return super(Cell, self).save(*args, **kwargs)
+
+        # when moving, the subtree content leaves the shares of the
+        # old place and joins the shares of the new one
+        moved = self.pk and \
+                self._mptt_cached_fields.get('parent') != self.parent_id
+        if moved:
+            old_shares = set(self.get_shares().values_list('user', flat=True))
+
+        retval = super(Cell, self).save(*args, **kwargs)
+
+        if moved:
+            new_shares = set(self.get_shares().values_list('user', flat=True))
+            if old_shares != new_shares:
+                size = self.content_size()
+                UserProfile.objects.filter(user__in=old_shares - new_shares).\
+                    update(shared_quota=F('shared_quota') - size)
+                UserProfile.objects.filter(user__in=new_shares - old_shares).\
+                    update(shared_quota=F('shared_quota') + size)
+
+        return retval
+
+    def content_size(self):
+        """
+        Return the content size of the not deleted droplets under this
+        cell and its descendants
+        """
+        return Droplet.objects.filter(self.subtree_q('cell'), deleted=False).\
+               aggregate(size=Sum('dropletrevision__content_size'))\
+               ['size'] or 0
+
+    def get_shares(self):
+        """
+        Return the shares of this cell and of its ancestors.
+
+        Shares are matched on the tree range of their cell, which
+        costs a single indexed query instead of an ancestors subquery.
+        """
+        return Share.objects.filter(cell__tree_id=self.tree_id,
+                                    cell__lft__lte=self.lft,
+                                    cell__rght__gte=self.rght)
+
+    def subtree_q(self, field=None):
+        """
+        Return a Q matching this cell and its descendants. If field is
+        given, match objects whose field points into the subtree.
+        """
+        prefix = '%s__' % field if field else ''
+        return Q(**{prefix + 'tree_id': self.tree_id,
+                    prefix + 'lft__gte': self.lft,
+                    prefix + 'rght__lte': self.rght})
 
     def set_deleted(self):
-        # set children cells and droplets to deleted
-        self.get_descendants().update(deleted=True, updated=datetime.now())
+        """
+        Mark this cell, its descendants and their droplets deleted.
+
+        Cells and droplets are matched by tree range and updated with
+        one query per table, so no per droplet signals run. The quota
+        is adjusted once for the whole subtree and a single subtree
+        entry is added to the journal.
+        """
+        now = datetime.now()
+        droplets = Droplet.objects.filter(self.subtree_q('cell'), deleted=False)
+        size = droplets.aggregate(size=Sum('dropletrevision__content_size'))\
+               ['size'] or 0
+
+        # shares inside the subtree lose only part of the content,
+        # they get recalculated after the update
+        inner_users = set(Share.objects.filter(self.subtree_q('cell')).\
+                          exclude(cell=self).values_list('user', flat=True))
+
+        droplets.update(deleted=True, updated=now)
+        self.get_descendants().update(deleted=True, updated=now)
         self.deleted=True
         self.save()
 
-    @classmethod
-    def _revision_count(self, sender, instance, **kwargs):
-        instance.revisions = instance.cellrevision_set.count()
+        UserProfile.add_quota(self.owner_id, self, -size)
+        for profile in UserProfile.objects.filter(user__in=inner_users):
+            UserProfile.objects.filter(pk=profile.pk).\
+                update(shared_quota=profile.calculate_shared_quota())
+
+        Change.objects.create(cell=self, subtree=True)
 
 models.signals.post_save.connect(Cell._first_revision_creator, sender=Cell)
-models.signals.pre_save.connect(Cell._revision_count, sender=Cell)
 
 class CellRevision(models.Model):
     cell = models.ForeignKey(Cell)
@@ -120,13 +240,21 @@ class CellRevision(models.Model):
         Always get latest revision and set values. Used when adding
         new or when deleting the latest
 
+        cell.revisions holds the number of the latest revision
         """
         try:
-            rev = instance.cell.cellrevision_set.latest()
-        except Cell.DoesNotExist:
+            if 'created' in kwargs and \
+                   instance.number >= instance.cell.revisions:
+                # saving the latest revision, no need to look it up
+                rev = instance
+            else:
+                rev = instance.cell.cellrevision_set.latest()
+        except (Cell.DoesNotExist, CellRevision.DoesNotExist):
             # when delering the cell, safe to return
             return
 
+        instance.cell.revisions = rev.number
+
         if rev.name:
             instance.cell.name = rev.name
 
@@ -164,7 +292,7 @@ class Share(models.Model):
         if self.cell.owner == self.user:
             raise ValidationError("cell.owner is the same person as user")
 
-        if Share.objects.filter(cell__in=self.cell.get_ancestors()).count():
+        if self.cell.get_shares().exclude(cell=self.cell).count():
             # oups there is another cell higher in the tree shared. abort
             raise ValidationError("Tree is already shared from another cell")
 
@@ -191,12 +319,12 @@ class Droplet(models.Model):
     cell = models.ForeignKey(Cell)
     deleted = models.BooleanField(default=False)
     content = models.FileField(
-        storage=FileSystemStorage(location=settings.MELISSI_STORE_LOCATION),
-        upload_to=calculate_upload_path,
+        storage=blob_storage,
+        upload_to=calculate_content_path,
         blank=False,
         null=False)
     patch = models.FileField(
-        storage=FileSystemStorage(location=settings.MELISSI_STORE_LOCATION),
+        storage=file_storage,
         upload_to=calculate_upload_path,
         blank=True,
         null=True,
@@ -209,10 +337,68 @@ class Droplet(models.Model):
     def __unicode__(self):
         return self.name
 
+    @classmethod
+    def _clean_droplet(self, sender, instance, **kwargs):
+        instance.clean()
+
+    def clean(self):
+        # content is stored by its hash, so new content must be
+        # verified before it reaches the store
+        if self.content and not self.content._committed:
+            if not self.content_sha256:
+                raise ValidationError("Cannot have content without content sha256")
+
+            verify_content(self.content, self.content_sha256,
+                           getattr(self, '_verified_content', None))
+
+        return super(Droplet, self).clean()
+
     def save(self, *args, **kwargs):
+        # patches are stored under the droplet id, which a new droplet
+        # does not have yet. Its first revision stores the patch once
+        # the droplet is inserted, see _first_revision_creator
+        patch = None
+        if self.pk is None and self.patch and not self.patch._committed:
+            patch, self.patch = self.patch, None
+            self._first_patch = patch.file
+
         # set owner always to cell.owner
         self.owner = self.cell.owner
-        return super(Droplet, self).save(*args, **kwargs)
+
+        # revisions account their own content, here only moves,
+        # owner changes and deletions of existing droplets are
+        # handled. State is swapped before saving so nested saves from
+        # revision signals see no change.
+        old_state = self._quota_state
+        self._quota_state = (self.owner_id, self.cell_id, self.deleted)
+        created = self.pk is None
+
+        try:
+            retval = super(Droplet, self).save(*args, **kwargs)
+        finally:
+            if patch is not None:
+                del self._first_patch
+
+        if patch is not None and not self.patch:
+            # no first revision took it, forked droplets
+            patch.save(patch.name, patch.file)
+
+        if not created and old_state != self._quota_state:
+            size = self.dropletrevision_set.\
+                   aggregate(size=Sum('content_size'))['size'] or 0
+
+            owner_id, cell_id, deleted = old_state
+            if not deleted:
+                if cell_id == self.cell_id:
+                    cell = self.cell
+                else:
+                    cell = Cell.objects.get(pk=cell_id)
+                UserProfile.add_quota(owner_id, cell, -size)
+
+            if not self.deleted:
+                UserProfile.add_quota(self.owner_id, self.cell, size)
+
+        return retval
 
     def overall_size(self):
         size = self.dropletrevision_set.aggregate(content_size=Sum('content_size'),
@@ -220,41 +406,204 @@ class Droplet(models.Model):
                                                   )
         return (size['content_size'] or 0) + (size['patch_size'] or 0)
 
+    def fork(self, number):
+        """
+        Return a new droplet with the revisions of this one before
+        number, used when an uploaded revision conflicts.
+
+        Revisions are copied with a single INSERT ... SELECT, so
+        content is neither read nor hashed again and no per revision
+        signals run. Copies stored as reverse deltas keep their base in
+        this droplet and get rebuilt by _restore_dependents when it
+        goes away.
+        """
+        # the state the droplet had at revision number - 1
+        state = {}
+        for rev in self.dropletrevision_set.filter(number__lt=number).\
+                reverse().iterator():
+            if rev.name and 'name' not in state:
+                state['name'] = rev.name
+            if rev.cell_id and 'cell' not in state:
+                state['cell'] = rev.cell
+            if rev.content_sha256 and 'content' not in state:
+                state['content'] = rev
+            if rev.patch and 'patch' not in state:
+                state['patch'] = rev
+            if len(state) == 4:
+                break
+
+        head = state.get('content')
+        droplet = Droplet(owner=self.owner,
+                          created=self.created,
+                          name=state.get('name', self.name),
+                          cell=state.get('cell', self.cell),
+                          deleted=self.deleted,
+                          revisions=number - 1)
+        if head:
+            droplet.content = head.content.name or \
+                              calculate_blob_path(head.content_sha256)
+            droplet.content_sha256 = head.content_sha256
+        if 'patch' in state:
+            droplet.patch = state['patch'].patch.name
+            droplet.patch_sha256 = state['patch'].patch_sha256
+
+        # revisions are copied below, not created
+        droplet.forked = True
+        droplet.save()
+
+        opts = DropletRevision._meta
+        qn = connection.ops.quote_name
+        columns = ', '.join([qn(f.column) for f in opts.local_fields
+                             if not f.primary_key and f.name != 'droplet'])
+        cursor = connection.cursor()
+        cursor.execute("INSERT INTO %(table)s (%(droplet)s, %(columns)s) "
+                       "SELECT %%s, %(columns)s FROM %(table)s "
+                       "WHERE %(droplet)s = %%s AND %(number)s < %%s" % {
+                           'table': qn(opts.db_table),
+                           'droplet': qn(opts.get_field('droplet').column),
+                           'number': qn(opts.get_field('number').column),
+                           'columns': columns},
+                       [droplet.pk, self.pk, number])
+        transaction.commit_unless_managed()
+
+        # blobs gain a reference per copy, grouped so that usually a
+        # single update is needed
+        copies = {}
+        for name, sha256 in droplet.dropletrevision_set.\
+                values_list('content', 'content_sha256'):
+            if sha256 and name == calculate_blob_path(sha256):
+                copies[sha256] = copies.get(sha256, 0) + 1
+        by_count = {}
+        for sha256, count in copies.items():
+            by_count.setdefault(count, []).append(sha256)
+        for count, shas in by_count.items():
+            Blob.objects.filter(sha256__in=shas).\
+                update(refcount=F('refcount') + count, updated=datetime.now())
+
+        # the newest content may be a delta from a revision that was
+        # not copied
+        if head and head.delta:
+            droplet.dropletrevision_set.get(number=head.number).\
+                restore_content()
+
+        if not droplet.deleted:
+            size = droplet.dropletrevision_set.\
+                   aggregate(size=Sum('content_size'))['size'] or 0
+            UserProfile.add_quota(droplet.owner_id, droplet.cell, size)
+
+        return droplet
+
+    def expired_revisions(self, last, days=0, weeks=0, max_bytes=None,
+                          now=None):
+        """
+        Return the primary keys of the revisions outside the retention
+        policy: the last revisions are kept, then the newest revision
+        of each of the last days and of each of the last weeks. While
+        the kept revisions hold more than max_bytes of content the
+        oldest of them expire too.
+
+        The latest revision and the latest revision with content,
+        which the droplet is read from, never expire. Revisions only
+        carry their name, content and cell when these change, so the
+        revisions kept ones take them from never expire either, even
+        beyond max_bytes.
+        """
+        now = now or datetime.now()
+        last = max(last, 1)
+        kept = []
+        expired = []
+        seen_days = set()
+        seen_weeks = set()
+        content_seen = False
+
+        revisions = list(self.dropletrevision_set.reverse().\
+                         values_list('pk', 'created', 'content', 'content_size',
+                                     'name', 'content_sha256', 'cell'))
+        for i, (pk, created, content, size, name, sha256, cell) in \
+                enumerate(revisions):
+            day = created.date()
+            week = created.isocalendar()[:2]
+            required = i == 0 or (content and not content_seen)
+            content_seen = content_seen or bool(content)
+
+            if required or i < last:
+                keep = True
+            elif now - created < timedelta(days=days) and \
+                     day not in seen_days:
+                keep = True
+            elif now - created < timedelta(weeks=weeks) and \
+                     week not in seen_weeks:
+                keep = True
+            else:
+                keep = False
+
+            if keep:
+                seen_days.add(day)
+                seen_weeks.add(week)
+                kept.append((pk, size or 0, required))
+            else:
+                expired.append(pk)
+
+        if max_bytes is not None:
+            total = sum(size for pk, size, required in kept)
+            for pk, size, required in reversed(kept):
+                if total <= max_bytes:
+                    break
+                if not required:
+                    expired.append(pk)
+                    total -= size
+
+        # oldest first, the latest name, content and cell at or below
+        # each kept revision stay
+        expired = set(expired)
+        providers = {}
+        for pk, created, content, size, name, sha256, cell in \
+                reversed(revisions):
+            for field, value in (('name', name), ('content', sha256),
+                                 ('cell', cell)):
+                if value is not None:
+                    providers[field] = pk
+            if pk not in expired:
+                expired.difference_update(providers.values())
+
+        return [pk for pk, created, content, size, name, sha256, cell
+                in revisions if pk in expired]
+
     def set_deleted(self):
         # set deleted
         self.deleted = True
         self.save()
 
     @classmethod
-    def _first_revision_creator(self, sender, instance, **kwargs):
-        if instance.dropletrevision_set.count() == 0:
-            # create first revision
+    def _track_quota_state(self, sender, instance, **kwargs):
+        instance._quota_state = (instance.owner_id,
+                                 instance.cell_id,
+                                 instance.deleted)
+
+    @classmethod
+    def _first_revision_creator(self, sender, instance, created, **kwargs):
+        if created and not getattr(instance, 'forked', False):
+            # create first revision, with the resource given by the
+            # creator if any
+            resource = getattr(instance, 'resource', None) or \
+                       instance.owner.userresource_set.all()[0]
             revision = DropletRevision(droplet=instance,
                                        name = instance.name,
                                        content = instance.content,
-                                       patch = instance.patch,
+                                       patch = getattr(instance,
+                                                       '_first_patch',
+                                                       instance.patch),
                                        content_sha256 = instance.content_sha256,
                                        patch_sha256 = instance.patch_sha256,
-                                       resource=instance.owner.userresource_set.all()[0],
+                                       resource=resource,
                                        cell=instance.cell,
                                        number=1)
             revision.save()
 
-    @classmethod
-    def _revision_count(self, sender, instance, **kwargs):
-        if isinstance(instance, Droplet):
-            instance.revisions = instance.dropletrevision_set.count()
-
-        elif isinstance(instance, DropletRevision):
-            try:
-                instance.droplet.revisions = instance.droplet.dropletrevision_set.count()
-                instance.droplet.save()
-            except Droplet.DoesNotExist:
-                # we are deleting the droplet, ignore
-                return
-
+models.signals.post_init.connect(Droplet._track_quota_state, sender=Droplet)
+models.signals.post_init.connect(track_verified_content, sender=Droplet)
 models.signals.post_save.connect(Droplet._first_revision_creator, sender=Droplet)
-models.signals.pre_save.connect(Droplet._revision_count, sender=Droplet)
+models.signals.pre_save.connect(Droplet._clean_droplet, sender=Droplet)
 
 
 class DropletRevision(models.Model):
@@ -265,13 +614,13 @@ class DropletRevision(models.Model):
     number = models.PositiveIntegerField()
     cell = models.ForeignKey(Cell, blank=True, null=True)
     content = models.FileField(
-        storage=FileSystemStorage(location=settings.MELISSI_STORE_LOCATION),
-        upload_to=calculate_upload_path,
+        storage=blob_storage,
+        upload_to=calculate_content_path,
         blank=True,
         default=None,
         null=True)
     patch = models.FileField(
-        storage=FileSystemStorage(location=settings.MELISSI_STORE_LOCATION),
+        storage=file_storage,
         upload_to=calculate_upload_path,
         blank=True,
         null=True,
@@ -296,6 +645,21 @@ class DropletRevision(models.Model):
                                              null=True,
                                              default=None
                                              )
+    # with MELISSI_REVERSE_DELTAS old content is replaced by a
+    # librsync delta that rebuilds it from the content of delta_base
+    delta = models.FileField(
+        storage=file_storage,
+        upload_to=calculate_delta_path,
+        blank=True,
+        null=True,
+        default=None
+        )
+    delta_base = models.ForeignKey('self',
+                                   blank=True,
+                                   null=True,
+                                   default=None,
+                                   related_name='delta_dependents',
+                                   on_delete=models.SET_NULL)
 
     class Meta:
         unique_together = (('droplet', 'number'),)
@@ -321,20 +685,54 @@ class DropletRevision(models.Model):
 
         elif self.content and self.content_sha256:
             # verify hash
-            if str(self.content_sha256) != calculate_sha256(self.content):
+            verify_content(self.content, self.content_sha256,
+                           getattr(self, '_verified_content', None))
+
+        if self.patch and self.patch_sha256 and not self.patch._committed:
+            # verify hash
+            if self.patch_sha256 != calculate_sha256(self.patch):
                 raise ValidationError("Hashes do not match")
 
+        return super(DropletRevision, self).clean()
 
-        # TODO patch match by applied before hash checking
-        # if self.patch and not self.patch_sha256:
-        #     raise ValidationError("Cannot have patch without patch sha256")
+    def apply_patch(self):
+        """
+        Set content to the result of applying patch on the content of
+        the previous revision. The result is hashed while read once
+        and must match content_sha256.
+        """
+        if not self.content_sha256:
+            raise ValidationError("Cannot have patch without content sha256")
 
-        # elif self.patch and self.patch_sha256:
-        #     # verify hash
-        #     if self.patch_sha256 != calculate_hash(self.patch):
-        #         raise ValidationError("Hashes do not match")
+        try:
+            base = self.droplet.dropletrevision_set.\
+                   filter(content_sha256__isnull=False,
+                          number__lt=self.number).reverse()[0]
+        except IndexError:
+            raise ValidationError("No previous content to patch")
 
-        return super(DropletRevision, self).clean()
+        source = blob_storage.open(base.content_file().name, 'rb')
+        try:
+            patched = patch_file(source, self.patch)
+
+            h = hashlib.sha256()
+            size = 0
+            for chunk in iter(lambda: patched.read(64 * 2 ** 10), ''):
+                h.update(chunk)
+                size += len(chunk)
+            patched.seek(0)
+
+        finally:
+            source.close()
+
+        if h.hexdigest() != self.content_sha256:
+            raise ValidationError("Hashes do not match")
+
+        content = File(patched, name=self.droplet.name)
+        content.size = size
+        # picked up by calculate_sha256, the result is not read again
+        content.sha256 = self.content_sha256
+        self.content = content
 
     def save(self, *args, **kwargs):
         try:
@@ -351,19 +749,178 @@ class DropletRevision(models.Model):
 
         return super(DropletRevision, self).save(*args, **kwargs)
 
+    def content_file(self, base=None):
+        """
+        Return the content of the revision. Content stored as a
+        reverse delta is rebuilt from base, by default delta_base, into
+        the blob store without a reference, so collect_garbage removes
+        it after its grace time.
+        """
+        if not self.delta:
+            return self.content
+
+        name = calculate_blob_path(self.content_sha256)
+        if not blob_storage.exists(name):
+            base = (base or self.delta_base).content_file()
+            source = blob_storage.open(base.name, 'rb')
+            try:
+                blob_storage.save(name,
+                                  sized_file(patch_file(source, self.delta)))
+            finally:
+                source.close()
+
+            Blob.objects.get_or_create(sha256=self.content_sha256)
+
+        return FieldFile(self, self._meta.get_field('content'), name)
+
+    def signature_file(self):
+        """
+        Return the librsync signature of the content. Signatures are
+        cached in the store by content sha256 and removed together with
+        their blob by collect_garbage.
+        """
+        name = calculate_signature_path(self.content_sha256)
+        if not blob_storage.exists(name):
+            source = blob_storage.open(self.content_file().name, 'rb')
+            try:
+                blob_storage.save(name, sized_file(signature_file(source)))
+            finally:
+                source.close()
+
+        return FieldFile(self, self._meta.get_field('content'), name)
+
+    def delta_from(self, base):
+        """
+        Return the librsync delta that turns the content of revision
+        base into the content of this revision. Deltas are built from
+        the cached signature of base and cached in the store by the
+        pair of content sha256. Using a cached delta refreshes its
+        modification time, mls_purge expires the ones not used lately.
+        """
+        name = calculate_delta_cache_path(base.content_sha256,
+                                          self.content_sha256)
+        if blob_storage.exists(name):
+            os.utime(blob_storage.path(name), None)
+
+        else:
+            signature = blob_storage.open(base.signature_file().name, 'rb')
+            target = blob_storage.open(self.content_file().name, 'rb')
+            try:
+                blob_storage.save(name, sized_file(delta_file(signature,
+                                                              target)))
+            finally:
+                signature.close()
+                target.close()
+
+        return FieldFile(self, self._meta.get_field('content'), name)
+
+    def store_reverse_delta(self, newer):
+        """
+        Replace the content of the revision with a delta from the
+        content of the newer revision
+        """
+        # content under a legacy name holds no blob reference
+        sha256 = Blob._stored_sha256(self)
+        source = blob_storage.open(newer.content.name, 'rb')
+        target = blob_storage.open(self.content.name, 'rb')
+        try:
+            self.delta.save('delta',
+                            sized_file(delta_file(signature_file(source),
+                                                  target)),
+                            save=False)
+        finally:
+            source.close()
+            target.close()
+
+        DropletRevision.objects.filter(pk=self.pk).\
+            update(content=None, delta=self.delta.name, delta_base=newer)
+        if sha256:
+            Blob.remove_reference(sha256)
+
+        self.content = None
+        self.delta_base = newer
+
+    def restore_content(self, base=None):
+        """
+        Store the full content of a revision kept as a reverse delta
+        """
+        content = self.content_file(base)
+
+        DropletRevision.objects.filter(pk=self.pk).\
+            update(content=content.name, delta=None, delta_base=None)
+        Blob.add_reference(self.content_sha256)
+        # conflict forks share delta files
+        if not DropletRevision.objects.filter(delta=self.delta.name).\
+               exclude(pk=self.pk).count():
+            self.delta.delete(save=False)
+
+        self.content = content.name
+        self.delta_base = None
+
+    @classmethod
+    def _store_reverse_delta(self, sender, instance, created, **kwargs):
+        """
+        Keep only the newest content of a droplet in full. The
+        previous content becomes a reverse delta, except every
+        MELISSI_KEYFRAME_INTERVAL revisions and when its blob is
+        shared with other revisions anyway.
+        """
+        if not created or not instance.content or \
+               not getattr(settings, 'MELISSI_REVERSE_DELTAS', False):
+            return
+
+        try:
+            previous = instance.droplet.dropletrevision_set.\
+                       filter(content_sha256__isnull=False,
+                              number__lt=instance.number).reverse()[0]
+        except IndexError:
+            return
+
+        interval = getattr(settings, 'MELISSI_KEYFRAME_INTERVAL', 10)
+        if not previous.content or previous.number % interval == 0 or \
+               previous.content_sha256 == instance.content_sha256 or \
+               Blob.objects.filter(sha256=Blob._stored_sha256(previous),
+                                   refcount__gt=1).count():
+            return
+
+        previous.store_reverse_delta(instance)
+
+    @classmethod
+    def _remember_dependents(self, sender, instance, **kwargs):
+        instance._delta_dependents = list(instance.delta_dependents.\
+                                          values_list('pk', flat=True))
+
+    @classmethod
+    def _restore_dependents(self, sender, instance, **kwargs):
+        """
+        Revisions rebuilt from a deleted revision get their content
+        back, unless they got deleted as well
+        """
+        for revision in DropletRevision.objects.\
+                filter(pk__in=getattr(instance, '_delta_dependents', [])):
+            revision.restore_content(instance)
+
     @classmethod
     def _update_droplet(self, sender, instance, **kwargs):
         """
         Always get latest revision and set values. Used when adding
         new or when deleting the latest
 
+        droplet.revisions holds the number of the latest revision
         """
         try:
-            rev = instance.droplet.dropletrevision_set.latest()
-        except Droplet.DoesNotExist:
+            if 'created' in kwargs and \
+                   instance.number >= instance.droplet.revisions:
+                # saving the latest revision, no need to look it up
+                rev = instance
+            else:
+                rev = instance.droplet.dropletrevision_set.latest()
+        except (Droplet.DoesNotExist, DropletRevision.DoesNotExist):
             # when deleting the droplet, safe to return
             return
 
+        instance.droplet.revisions = rev.number
+
         if rev.name:
             instance.droplet.name = rev.name
 
@@ -380,6 +937,43 @@ class DropletRevision(models.Model):
 
         instance.droplet.save()
 
+    @classmethod
+    def _update_quota(self, sender, instance, **kwargs):
+        """
+        Add the content of new revisions to the quota and remove the
+        content of deleted ones. Runs before _update_droplet, so the
+        droplet is still in its previous cell and moves are left to
+        Droplet.save
+
+        Droplets with defer_quota set are accounted by their creator.
+        """
+        if 'created' in kwargs and not kwargs['created']:
+            return
+
+        droplet = instance.droplet
+        if droplet.deleted or getattr(droplet, 'defer_quota', False) or \
+               not instance.content_size:
+            return
+
+        size = instance.content_size
+        if 'created' not in kwargs:
+            # deleting
+            size = -size
+
+        UserProfile.add_quota(droplet.owner_id, droplet.cell, size)
+
+# update quota before updating the droplet
+models.signals.post_save.connect(DropletRevision._update_quota,
+                                 sender=DropletRevision)
+models.signals.pre_delete.connect(DropletRevision._update_quota,
+                                  sender=DropletRevision)
+
+# restore reverse deltas before updating the droplet
+models.signals.pre_delete.connect(DropletRevision._remember_dependents,
+                                  sender=DropletRevision)
+models.signals.post_delete.connect(DropletRevision._restore_dependents,
+                                   sender=DropletRevision)
+
 # update droplet
 models.signals.post_save.connect(DropletRevision._update_droplet,
                                  sender=DropletRevision)
@@ -388,9 +982,440 @@ models.signals.post_delete.connect(DropletRevision._update_droplet,
 
 models.signals.pre_save.connect(DropletRevision._clean_dropletrevision,
                                 sender=DropletRevision)
-models.signals.post_delete.connect(Droplet._revision_count, sender=DropletRevision)
+models.signals.post_init.connect(track_verified_content,
+                                 sender=DropletRevision)
 
 
+class Blob(models.Model):
+    """
+    Reference count of a content blob in the blob store. Blobs with no
+    references left are removed by collect_garbage.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    refcount = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return self.sha256
+
+    @property
+    def path(self):
+        return calculate_blob_path(self.sha256)
+
+    @classmethod
+    def _stored_sha256(self, revision):
+        """ Return the sha256 of the blob revision points to, or None
+        if the revision has no content in the blob store
+        """
+        if revision.content and revision.content_sha256 and \
+               revision.content.name == calculate_blob_path(revision.content_sha256):
+            return revision.content_sha256
+
+        return None
+
+    @classmethod
+    def add_reference(self, sha256):
+        if not Blob.objects.filter(sha256=sha256).\
+               update(refcount=F('refcount') + 1, updated=datetime.now()):
+            Blob.objects.create(sha256=sha256, refcount=1)
+
+    @classmethod
+    def add_unreferenced(self, sha256):
+        """
+        Make sure a blob that may be in the blob store has a row, so
+        that collect_garbage removes it unless something references it
+        meanwhile. For blobs saved by transactions that were rolled
+        back.
+        """
+        if len(sha256) != 64 or sha256.strip('0123456789abcdef') or \
+               not blob_storage.exists(calculate_blob_path(sha256)):
+            return
+
+        try:
+            with transaction.commit_on_success():
+                Blob.objects.get_or_create(sha256=sha256)
+        except IntegrityError:
+            # created meanwhile
+            pass
+
+    @classmethod
+    def remove_reference(self, sha256):
+        Blob.objects.filter(sha256=sha256).\
+                       update(refcount=F('refcount') - 1, updated=datetime.now())
+
+    @classmethod
+    def _add_reference(self, sender, instance, created, **kwargs):
+        sha256 = Blob._stored_sha256(instance)
+        if not created or not sha256:
+            return
+
+        Blob.add_reference(sha256)
+
+    @classmethod
+    def _remove_reference(self, sender, instance, **kwargs):
+        sha256 = Blob._stored_sha256(instance)
+        if not sha256:
+            return
+
+        Blob.remove_reference(sha256)
+
+    @classmethod
+    def collect_garbage(self, grace=timedelta(hours=1)):
+        """
+        Delete blobs without references, that have not been touched
+        for grace time. Returns the number of bytes reclaimed.
+        """
+        reclaimed = 0
+        cutoff = datetime.now() - grace
+        for blob in Blob.objects.filter(refcount__lte=0,
+                                        updated__lt=cutoff).iterator():
+            try:
+                stat = os.stat(blob_storage.path(blob.path))
+            except OSError:
+                # file already gone
+                stat = None
+
+            if stat and datetime.fromtimestamp(stat.st_mtime) >= cutoff:
+                # a new upload reused the blob meanwhile
+                continue
+
+            if not Blob.objects.filter(pk=blob.pk, refcount__lte=0).count():
+                continue
+
+            blob.delete()
+
+            if stat:
+                chunks = None
+                if getattr(blob_storage, 'chunked', False):
+                    try:
+                        chunks = blob_storage.read_manifest(blob.path)
+                    except ValueError:
+                        # damaged, its chunks are left referenced
+                        pass
+
+                blob_storage.delete(blob.path)
+                reclaimed += stat.st_size
+
+                if chunks:
+                    Chunk.remove_references(chunks)
+
+            signature = calculate_signature_path(blob.sha256)
+            if blob_storage.exists(signature):
+                reclaimed += os.path.getsize(blob_storage.path(signature))
+                blob_storage.delete(signature)
+
+        # chunks only listed by the removed blobs go too
+        if getattr(blob_storage, 'chunked', False):
+            reclaimed += Chunk.collect_garbage(grace)
+
+        return reclaimed
+
+models.signals.post_save.connect(Blob._add_reference, sender=DropletRevision)
+models.signals.post_delete.connect(Blob._remove_reference, sender=DropletRevision)
+models.signals.post_save.connect(DropletRevision._store_reverse_delta,
+                                 sender=DropletRevision)
+
+
+class Chunk(models.Model):
+    """
+    Reference count of a chunk of the chunked blob store, one for
+    every time a manifest lists it. Chunks with no references left are
+    removed by collect_garbage.
+    """
+    sha256 = models.CharField(max_length=64, unique=True)
+    refcount = models.IntegerField(default=0)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return self.sha256
+
+    @property
+    def path(self):
+        return calculate_chunk_path(self.sha256)
+
+    @classmethod
+    def _counts(self, chunks):
+        counts = {}
+        for sha256, size in chunks:
+            counts[sha256] = counts.get(sha256, 0) + 1
+        return counts
+
+    @classmethod
+    def add_unreferenced(self, sha256):
+        """
+        Make sure the chunk with hexdigest sha256 has a row before its
+        file is saved, so that collect_garbage finds the file if it is
+        never referenced
+        """
+        if Chunk.objects.filter(sha256=sha256).update(updated=datetime.now()):
+            return
+
+        try:
+            with transaction.commit_on_success():
+                Chunk.objects.create(sha256=sha256)
+        except IntegrityError:
+            # created meanwhile
+            pass
+
+    @classmethod
+    def add_references(self, chunks):
+        """ Add a reference for every (sha256, size) of chunks
+        """
+        for sha256, count in Chunk._counts(chunks).items():
+            Chunk.objects.filter(sha256=sha256).\
+                update(refcount=F('refcount') + count, updated=datetime.now())
+
+    @classmethod
+    def remove_references(self, chunks):
+        """ Remove a reference for every (sha256, size) of chunks
+        """
+        for sha256, count in Chunk._counts(chunks).items():
+            Chunk.objects.filter(sha256=sha256).\
+                update(refcount=F('refcount') - count, updated=datetime.now())
+
+    @classmethod
+    def chunk_blob(self, sha256):
+        """
+        Replace the whole file of the blob with hexdigest sha256 by a
+        manifest of its chunks. Returns False if the blob is chunked
+        already or gone.
+        """
+        name = calculate_blob_path(sha256)
+        if not blob_storage.exists(name) or blob_storage.has_manifest(name):
+            return False
+
+        chunks = []
+        for chunk_sha256, data in blob_storage.split(name):
+            Chunk.add_unreferenced(chunk_sha256)
+            blob_storage.save(calculate_chunk_path(chunk_sha256),
+                              ContentFile(data))
+            chunks.append((chunk_sha256, len(data)))
+
+        # the references are committed before the manifest replaces
+        # the file, so its chunks are never collected under it
+        with transaction.commit_on_success():
+            Chunk.add_references(chunks)
+
+        try:
+            blob_storage.save_manifest(name, chunks)
+        except:
+            with transaction.commit_on_success():
+                Chunk.remove_references(chunks)
+            raise
+
+        return True
+
+    @classmethod
+    def collect_garbage(self, grace=timedelta(hours=1)):
+        """
+        Delete chunks without references, that have not been touched
+        for grace time. Returns the number of bytes reclaimed.
+        """
+        reclaimed = 0
+        cutoff = datetime.now() - grace
+        for chunk in Chunk.objects.filter(refcount__lte=0,
+                                          updated__lt=cutoff).iterator():
+            try:
+                stat = os.stat(blob_storage.path(chunk.path))
+            except OSError:
+                stat = None
+
+            if stat and datetime.fromtimestamp(stat.st_mtime) >= cutoff:
+                # being saved for a new manifest
+                continue
+
+            if not Chunk.objects.filter(pk=chunk.pk, refcount__lte=0,
+                                        updated__lt=cutoff).count():
+                continue
+
+            chunk.delete()
+
+            if stat:
+                blob_storage.delete(chunk.path)
+                reclaimed += stat.st_size
+
+        return reclaimed
+
+
+class ChangeSequence(models.Model):
+    """
+    Counter Change.sequence numbers are taken from, a single row.
+    Updating it locks the row, so entries are numbered one reader at
+    a time.
+    """
+    value = models.PositiveIntegerField(default=0)
+
+class Change(models.Model):
+    """
+    Append only journal of changes. Entries are numbered by sequence
+    in the order they are committed, so clients can ask for everything
+    after the last sequence they have seen. Ids are handed out when
+    entries are written and transactions commit out of order, an
+    entry with a lower id may show up after a higher id was read.
+
+    A subtree entry marks the cell and everything below it as changed
+    (used when cells are moved or deleted and when a share is created
+    or changed).
+    A subtree entry with a user is only reported to that user. An
+    unshared entry tells user that the cell is no longer shared with
+    him.
+    """
+    cell = models.ForeignKey(Cell)
+    droplet = models.ForeignKey(Droplet, blank=True, null=True, default=None)
+    user = models.ForeignKey(User, blank=True, null=True, default=None)
+    subtree = models.BooleanField(default=False)
+    unshared = models.BooleanField(default=False)
+    sequence = models.PositiveIntegerField(blank=True, null=True, default=None,
+                                           db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ("id",)
+
+    def __unicode__(self):
+        return unicode(self.id)
+
+    @classmethod
+    @transaction.commit_on_success()
+    def latest_id(self):
+        """
+        Number the committed entries that have no sequence yet and
+        return the latest sequence. Entries committed later get a
+        higher sequence, so a cursor never skips them.
+        """
+        if Change.objects.filter(sequence__isnull=True).exists():
+            # the update locks the counter until commit
+            if not ChangeSequence.objects.filter(pk=1).\
+                   update(value=F('value') + 1):
+                ChangeSequence.objects.create(pk=1, value=1)
+            latest = ChangeSequence.objects.get(pk=1).value
+            Change.objects.filter(sequence__isnull=True).update(sequence=latest)
+            return latest
+
+        try:
+            return ChangeSequence.objects.get(pk=1).value
+        except ChangeSequence.DoesNotExist:
+            return 0
+
+    @classmethod
+    def _record_cell(self, sender, instance, **kwargs):
+        Change.objects.create(cell=instance)
+
+    @classmethod
+    def _record_cell_move(self, sender, instance, created, **kwargs):
+        # first revisions are covered by the cell's own entry
+        if created and instance.parent and instance.number > 1:
+            Change.objects.create(cell=instance.cell, subtree=True)
+
+    @classmethod
+    def _record_droplet(self, sender, instance, **kwargs):
+        Change.objects.create(cell=instance.cell, droplet=instance)
+
+    @classmethod
+    def _record_share(self, sender, instance, **kwargs):
+        # renaming or moving the share moves the subtree for the user
+        Change.objects.create(cell=instance.cell, user=instance.user,
+                              subtree=True)
+
+    @classmethod
+    def _record_unshare(self, sender, instance, **kwargs):
+        # nothing to tell when the cell or the user is deleted along
+        # with the share
+        if not Cell.objects.filter(pk=instance.cell_id).exists() or \
+               not User.objects.filter(pk=instance.user_id).exists():
+            return
+
+        Change.objects.create(cell=instance.cell, user=instance.user,
+                              subtree=True, unshared=True)
+
+    @classmethod
+    def _notify(self, sender, instance, created, **kwargs):
+        """
+        Wake up clients waiting for changes of the owner and of the
+        users the cell is shared with
+        """
+        shares = Q(cell__tree_id=instance.cell.tree_id,
+                   cell__lft__lte=instance.cell.lft,
+                   cell__rght__gte=instance.cell.rght)
+        if instance.subtree:
+            # shares inside the subtree see the change too
+            shares |= instance.cell.subtree_q('cell')
+
+        users = set(Share.objects.filter(shares).values_list('user', flat=True))
+        users.add(instance.cell.owner_id)
+        if instance.user_id:
+            # for unshared entries the share is gone already
+            users.add(instance.user_id)
+
+        notify.notify_on_commit(users, instance.id)
+
+models.signals.post_save.connect(Change._record_cell, sender=Cell)
+models.signals.post_save.connect(Change._record_cell_move, sender=CellRevision)
+models.signals.post_save.connect(Change._record_droplet, sender=Droplet)
+models.signals.post_save.connect(Change._record_share, sender=Share)
+models.signals.post_delete.connect(Change._record_unshare, sender=Share)
+models.signals.post_save.connect(Change._notify, sender=Change)
+
+class UploadSession(models.Model):
+    """
+    Content uploaded in chunks, staged until it is posted as the
+    content of a droplet or revision
+    """
+    owner = models.ForeignKey(User)
+    size = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return unicode(self.id)
+
+    @property
+    def path(self):
+        return os.path.join(settings.MELISSI_STORE_LOCATION,
+                            'uploads', str(self.id))
+
+    def write(self, offset, data):
+        """
+        Write data at offset, dropping anything staged after offset
+        """
+        if offset < 0 or offset > self.size:
+            raise ValueError("Offset outside of upload")
+
+        f = open(self.path, 'r+b')
+        try:
+            f.seek(offset)
+            f.truncate()
+            f.write(data)
+        finally:
+            f.close()
+
+        self.size = offset + len(data)
+        self.save()
+
+    def uploaded_file(self, name):
+        return StagedUploadedFile(self.path, name)
+
+    @classmethod
+    def _create_file(self, sender, instance, created, **kwargs):
+        if not created:
+            return
+
+        directory = os.path.dirname(instance.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        open(instance.path, 'wb').close()
+
+    @classmethod
+    def _delete_file(self, sender, instance, **kwargs):
+        # the file is gone when it got moved into the blob store
+        if os.path.exists(instance.path):
+            os.remove(instance.path)
+
+models.signals.post_save.connect(UploadSession._create_file, sender=UploadSession)
+models.signals.post_delete.connect(UploadSession._delete_file,
+                                   sender=UploadSession)
+
 class UserResource(models.Model):
     name = models.CharField(max_length=500, default="melissi")
     user = models.ForeignKey(User)
@@ -437,64 +1462,46 @@ class UserProfile(models.Model):
         return self.personal_quota
 
     def calculate_shared_quota(self):
-        shares = Share.objects.filter(user=self.user)
+        shares = Share.objects.filter(user=self.user).select_related('cell')
         self.shared_quota = 0
 
         for share in shares:
-            cell = share.cell
-            self.shared_quota +=\
-                 Droplet.objects.filter(Q(cell__in = cell.get_descendants())|\
-                                        Q(cell = cell)).\
-                                        filter(deleted=False).\
-                                        aggregate(quota=Sum('dropletrevision__content_size'))\
-                                        ['quota'] or 0
+            self.shared_quota += share.cell.content_size()
 
         return self.shared_quota
 
     @classmethod
-    def _update_quota(self, sender, instance, **kwargs):
-        if isinstance(instance, Droplet):
-            try:
-                cell = instance.cell
-            except Cell.DoesNotExist:
-                # cell already deleted
-                return
-
-        elif isinstance(instance, Cell):
-            cell = instance
+    def add_quota(self, user_id, cell, delta):
+        """
+        Add delta to the personal quota of user_id and to the shared
+        quota of the users cell is shared with.
 
-        try:
-            user = instance.owner
-        except User.DoesNotExist:
-            # we are deleting user. no need to count share, skip
+        Updates are applied in the database, so concurrent uploads do
+        not overwrite each other. Drift can be fixed with the
+        mls_quota command.
+        """
+        if not delta:
             return
-        profile = user.get_profile()
-
-        profile.calculate_quota()
 
-        # if droplet is in a shared tree, update shared_quota as well
-        try:
-            shared_cell = Share.objects.get(Q(cell=cell)|\
-                                            Q(cell__in=cell.get_ancestors())
-                                            )
-        except Share.DoesNotExist:
-            # not shared
-            pass
+        UserProfile.objects.filter(user=user_id).\
+            update(personal_quota=F('personal_quota') + delta)
+        UserProfile.objects.filter(user__in=cell.get_shares().values('user')).\
+            update(shared_quota=F('shared_quota') + delta)
 
-        else:
-            self.calculate_shared_quota()
+    @classmethod
+    def _update_shared_quota(self, sender, instance, **kwargs):
+        if 'created' in kwargs and not kwargs['created']:
+            return
 
-        profile.save()
+        for profile in UserProfile.objects.filter(user=instance.user_id):
+            UserProfile.objects.filter(pk=profile.pk).\
+                update(shared_quota=profile.calculate_shared_quota())
 
-# update quota
-models.signals.post_save.connect(UserProfile._update_quota,
-                                 sender=Droplet)
-models.signals.post_delete.connect(UserProfile._update_quota,
-                                 sender=Droplet)
-models.signals.post_save.connect(UserProfile._update_quota,
-                                 sender=Cell)
-models.signals.post_delete.connect(UserProfile._update_quota,
-                                 sender=Cell)
+# update shared quota when sharing starts or stops
+models.signals.post_save.connect(UserProfile._update_shared_quota,
+                                 sender=Share)
+models.signals.post_delete.connect(UserProfile._update_shared_quota,
+                                   sender=Share)
 
 def user_post_save(sender, instance, **kwargs):
     """
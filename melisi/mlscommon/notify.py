@@ -0,0 +1,125 @@
+"""
+File based notification bus.
+
+Every user has a file under MELISSI_STORE_LOCATION/notify holding
+the id of the latest journal entry that concerns the user. Writers replace
+the file atomically, waiters compare its content with the token they
+read before looking at the database. Works across server processes
+without touching the database while idle.
+
+Writers inside a transaction use notify_on_commit, waiters woken up
+before the commit would not find the changes yet. NotifyMiddleware
+sends what was queued once the request transaction has committed.
+"""
+import os
+import time
+import errno
+import uuid
+import threading
+
+from django.conf import settings
+from django.db import transaction
+
+_local = threading.local()
+
+def _path(user_id):
+    return os.path.join(settings.MELISSI_STORE_LOCATION, 'notify',
+                        str(user_id))
+
+def token(user_id):
+    """ Return the current token of user_id
+    """
+    try:
+        f = open(_path(user_id), 'rb')
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return ''
+
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def notify(user_ids, value):
+    """ Set the token of user_ids to value, waking their waiters
+    """
+    directory = os.path.dirname(_path(0))
+    try:
+        os.makedirs(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    for user_id in user_ids:
+        path = _path(user_id)
+        tmp_path = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        f = open(tmp_path, 'wb')
+        try:
+            f.write(str(value))
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+def notify_on_commit(user_ids, value):
+    """ Like notify, but wait for the running transaction to commit,
+    see flush
+    """
+    if not transaction.is_managed():
+        # autocommit, the change is committed already
+        notify(user_ids, value)
+        return
+
+    pending = getattr(_local, 'pending', None)
+    if pending is None:
+        pending = _local.pending = {}
+    for user_id in user_ids:
+        pending[user_id] = value
+
+def flush():
+    """ Send the notifications queued by notify_on_commit
+    """
+    pending = getattr(_local, 'pending', None)
+    _local.pending = None
+    if not pending:
+        return
+
+    by_value = {}
+    for user_id, value in pending.iteritems():
+        by_value.setdefault(value, []).append(user_id)
+    for value, user_ids in by_value.iteritems():
+        notify(user_ids, value)
+
+def discard():
+    """ Drop the notifications queued by notify_on_commit
+    """
+    _local.pending = None
+
+class NotifyMiddleware(object):
+    """
+    Send the notifications of a request after its transaction
+    committed. Goes before TransactionMiddleware in
+    MIDDLEWARE_CLASSES, so that it sees responses after the commit.
+    """
+    def process_request(self, request):
+        discard()
+
+    def process_exception(self, request, exception):
+        discard()
+
+    def process_response(self, request, response):
+        flush()
+        return response
+
+def wait(user_id, old_token, timeout, interval=0.5):
+    """ Block until the token of user_id differs from old_token or
+    timeout seconds pass. Return True if the token changed.
+    """
+    deadline = time.time() + timeout
+    while token(user_id) == old_token:
+        left = deadline - time.time()
+        if left <= 0:
+            return False
+        time.sleep(min(interval, left))
+
+    return True
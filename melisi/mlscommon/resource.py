@@ -3,10 +3,38 @@ Overloading piston resource to provide our own error handling methods
 """
 import piston.resource
 from piston.utils import rc
+from django.http import QueryDict
+from django.utils.datastructures import MultiValueDict
 
 from exceptions import APIException
+import emitters
+
+def _skip_form_data(request):
+    request._post = QueryDict('', encoding=request._encoding)
+    request._files = MultiValueDict()
 
 class Resource(piston.resource.Resource):
+    def __init__(self, handler, authentication=None, stream=None, raw=False):
+        super(Resource, self).__init__(handler, authentication)
+
+        # stream output of this resource, see emitters
+        if stream is not None:
+            self.stream = stream
+
+        # PUT bodies of this resource are raw bytes, not form data
+        self.raw = raw
+
+    def __call__(self, request, *args, **kwargs):
+        if self.raw and request.method.upper() == 'PUT':
+            # piston coerces PUT into POST and parses the body as form
+            # data, whatever the content type. Read the body first and
+            # keep it as it is in raw_post_data
+            request.raw_post_data
+            request.META['CONTENT_TYPE'] = 'application/octet-stream'
+            request._load_post_and_files = lambda: _skip_form_data(request)
+
+        return super(Resource, self).__call__(request, *args, **kwargs)
+
     def form_validation_response(self, e):
         resp = rc.BAD_REQUEST
         error_list = {}
@@ -0,0 +1,593 @@
+"""
+Content addressed storage for droplet contents.
+
+Every content blob is stored once, under a path calculated from its
+sha256 hexdigest. Saving a blob that is already in the store is a
+no-op, so identical files across users, revisions and conflict copies
+share one file on disk.
+
+With MELISSI_CHUNK_STORE blobs are split further into content defined
+chunks, see ChunkedStorage. With MELISSI_COMPRESS_STORE blobs, patches
+and deltas are stored compressed, see CompressingStorageMixin.
+"""
+import os
+import re
+import errno
+import uuid
+import gzip
+import shutil
+import random
+import struct
+import bisect
+import hashlib
+import tempfile
+import mimetypes
+
+from django.core.files.storage import FileSystemStorage
+from django.core.files.move import file_move_safe
+from django.core.files.base import File
+from django.conf import settings
+
+def calculate_blob_path(sha256):
+    """ Return the storage name of the blob with hexdigest sha256
+    """
+    return os.path.join('blobs', sha256[:2], sha256[2:4], sha256)
+
+def calculate_delta_cache_path(base_sha256, sha256):
+    """ Return the storage name of the cached librsync delta from the
+    blob with hexdigest base_sha256 to the blob with hexdigest sha256
+    """
+    return os.path.join('deltacache', base_sha256[:2], base_sha256[2:4],
+                        '%s-%s' % (base_sha256, sha256))
+
+def calculate_signature_path(sha256):
+    """ Return the storage name of the cached librsync signature of the
+    blob with hexdigest sha256
+    """
+    return os.path.join('signatures', sha256[:2], sha256[2:4], sha256)
+
+def calculate_shard(key):
+    """ Return the two level directory key is fanned out under, so no
+    directory of the store grows with the number of droplets
+    """
+    digest = hashlib.md5(str(key)).hexdigest()
+    return os.path.join(digest[:2], digest[2:4])
+
+def calculate_sharded_path(directory, key, *names):
+    """ Return the storage name of names under the sharded directory
+    of key in directory
+    """
+    return os.path.join(directory, calculate_shard(key), str(key),
+                        *[str(name) for name in names])
+
+def is_sharded(name):
+    """ Return True if name follows calculate_sharded_path
+    """
+    parts = name.split('/')
+    return len(parts) > 4 and \
+           os.path.join(parts[1], parts[2]) == calculate_shard(parts[3])
+
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    FileSystemStorage that never renames files. Names are expected to
+    be calculated with calculate_blob_path, so a name that already
+    exists holds exactly the same bytes and is not written again.
+    """
+    def get_available_name(self, name):
+        return name
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+
+        if os.path.exists(full_path):
+            # blob already stored, just refresh its modification time
+            # so the garbage collector leaves it alone
+            os.utime(full_path, None)
+            return name
+
+        directory = os.path.dirname(full_path)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # write to a temporary file in the same directory and rename,
+        # so concurrent uploads of the same blob never see half
+        # written files
+        tmp_path = '%s.%s.tmp' % (full_path, uuid.uuid4().hex)
+        try:
+            if getattr(content, 'staged', False):
+                # the upload session removes its file once committed
+                try:
+                    os.link(content.temporary_file_path(), tmp_path)
+                except OSError:
+                    shutil.copyfile(content.temporary_file_path(), tmp_path)
+
+            elif hasattr(content, 'temporary_file_path'):
+                file_move_safe(content.temporary_file_path(), tmp_path)
+                content.close()
+
+            else:
+                fd = os.open(tmp_path,
+                             os.O_WRONLY | os.O_CREAT | os.O_EXCL |\
+                             getattr(os, 'O_BINARY', 0))
+                f = os.fdopen(fd, 'wb')
+                try:
+                    for chunk in content.chunks():
+                        f.write(chunk)
+                finally:
+                    f.close()
+
+            os.rename(tmp_path, full_path)
+
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if settings.FILE_UPLOAD_PERMISSIONS is not None:
+            os.chmod(full_path, settings.FILE_UPLOAD_PERMISSIONS)
+
+        return name
+
+# manifests start with MANIFEST_MAGIC, followed by one
+# "<sha256> <size>" line per chunk
+MANIFEST_MAGIC = 'melissi-chunks 1\n'
+SHA256_RE = re.compile(r'^[0-9a-f]{64}\Z')
+
+# random values of the gear rolling hash, fixed so that chunk
+# boundaries never change between runs
+GEAR = [random.Random(i).getrandbits(32) for i in range(256)]
+
+def calculate_manifest_path(name):
+    """ Return the storage name of the manifest of the chunked file
+    name
+    """
+    return os.path.join('manifests', name)
+
+def calculate_chunk_path(sha256):
+    """ Return the storage name of the chunk with hexdigest sha256
+    """
+    return os.path.join('chunks', sha256[:2], sha256[2:4], sha256)
+
+def _find_boundary(buf, min_size, max_size, mask):
+    """ Return the length of the first chunk of buf, all of buf if it
+    ends before a boundary
+    """
+    limit = min(len(buf), max_size)
+    # the hash only depends on the last 32 bytes, so bytes further
+    # than that before min_size need not be hashed
+    h = 0
+    for i in xrange(max(min_size - 32, 0), limit):
+        h = ((h << 1) + GEAR[buf[i]]) & 0xffffffff
+        if not h & mask and i + 1 >= min_size:
+            return i + 1
+
+    return limit
+
+def split_chunks(content, average_size):
+    """
+    Yield content in content defined chunks of average_size on average
+    (a power of two), between a quarter and four times that.
+
+    Boundaries are placed where a gear rolling hash of the last bytes
+    matches a mask, so an insertion only changes the chunks around it.
+    """
+    bits = int(average_size).bit_length() - 1
+    mask = ((1 << bits) - 1) << (32 - bits)
+    min_size = average_size // 4
+    max_size = average_size * 4
+
+    buf = bytearray()
+    for data in content.chunks():
+        buf.extend(data)
+        # a boundary is final once max_size bytes are buffered
+        while len(buf) >= max_size:
+            end = _find_boundary(buf, min_size, max_size, mask)
+            yield str(buf[:end])
+            del buf[:end]
+
+    while buf:
+        end = _find_boundary(buf, min_size, max_size, mask)
+        yield str(buf[:end])
+        del buf[:end]
+
+class ChunkedFile(object):
+    """
+    Read only file object over the chunks of a manifest
+    """
+    def __init__(self, storage, chunks):
+        self.storage = storage
+        self.chunks = chunks
+        # start offset of every chunk
+        self.offsets = []
+        self.size = 0
+        for sha256, size in chunks:
+            self.offsets.append(self.size)
+            self.size += size
+        self.position = 0
+        self.closed = False
+        self._current = None
+
+    def _chunk_at(self, position):
+        i = bisect.bisect_right(self.offsets, position) - 1
+        return i, self.offsets[i]
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+
+        data = []
+        while size > 0 and self.position < self.size:
+            i, offset = self._chunk_at(self.position)
+            if self._current is None or self._current[0] != i:
+                f = open(self.storage.path(
+                    calculate_chunk_path(self.chunks[i][0])), 'rb')
+                try:
+                    self._current = (i, f.read())
+                finally:
+                    f.close()
+
+            start = self.position - offset
+            piece = self._current[1][start:start + size]
+            data.append(piece)
+            self.position += len(piece)
+            size -= len(piece)
+
+        return ''.join(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = max(offset, 0)
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        self.closed = True
+        self._current = None
+
+class ChunkedStorage(ContentAddressedStorage):
+    """
+    ContentAddressedStorage that can keep files as manifests of
+    content defined chunks. Chunks are stored once by their sha256, so
+    versions of a file and near duplicate files share most of their
+    bytes.
+
+    Files are saved whole, as uploads should not wait for chunking,
+    and replaced by manifests later with split and save_manifest, see
+    the mls_chunk command. Manifests are kept under the manifests
+    directory, apart from the whole files, so that no uploaded bytes
+    are ever taken for a manifest.
+    """
+    chunked = True
+
+    def __init__(self, average_size=64 * 2 ** 10, *args, **kwargs):
+        self.average_size = average_size
+        super(ChunkedStorage, self).__init__(*args, **kwargs)
+
+    def _manifest_path(self, name):
+        return super(ChunkedStorage, self).path(
+            calculate_manifest_path(name))
+
+    def has_manifest(self, name):
+        """ Return True if name is stored as a manifest
+        """
+        return os.path.exists(self._manifest_path(name))
+
+    def path(self, name):
+        if self.has_manifest(name):
+            return self._manifest_path(name)
+
+        return super(ChunkedStorage, self).path(name)
+
+    def read_manifest(self, name):
+        """
+        Return the (sha256, size) chunks of name, or None if name is
+        stored as a whole file. Raises ValueError if the manifest is
+        damaged.
+        """
+        try:
+            f = open(self._manifest_path(name), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+        try:
+            if f.read(len(MANIFEST_MAGIC)) != MANIFEST_MAGIC:
+                raise ValueError("Bad manifest of %s" % name)
+
+            chunks = []
+            for line in f:
+                fields = line.split()
+                if len(fields) != 2 or not SHA256_RE.match(fields[0]) or \
+                       not fields[1].isdigit():
+                    raise ValueError("Bad manifest of %s" % name)
+                chunks.append((fields[0], int(fields[1])))
+            return chunks
+        finally:
+            f.close()
+
+    def split(self, name):
+        """
+        Yield the (sha256, data) chunks of the whole file name. The
+        chunks are not saved.
+        """
+        path = super(ChunkedStorage, self).path(name)
+        content = File(open(path, 'rb'))
+        try:
+            for chunk in split_chunks(content, self.average_size):
+                yield hashlib.sha256(chunk).hexdigest(), chunk
+        finally:
+            content.close()
+
+    def save_manifest(self, name, chunks):
+        """
+        Replace the whole file name by a manifest of chunks, which
+        must be saved already under calculate_chunk_path
+        """
+        whole_path = super(ChunkedStorage, self).path(name)
+        full_path = self._manifest_path(name)
+        directory = os.path.dirname(full_path)
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        tmp_path = '%s.%s.tmp' % (full_path, uuid.uuid4().hex)
+        f = open(tmp_path, 'wb')
+        try:
+            try:
+                f.write(MANIFEST_MAGIC)
+                for sha256, size in chunks:
+                    f.write('%s %d\n' % (sha256, size))
+            finally:
+                f.close()
+
+            if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                os.chmod(tmp_path, settings.FILE_UPLOAD_PERMISSIONS)
+            os.rename(tmp_path, full_path)
+
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        os.remove(whole_path)
+
+    def delete(self, name):
+        if self.has_manifest(name):
+            os.remove(self._manifest_path(name))
+
+        super(ChunkedStorage, self).delete(name)
+
+    def _open(self, name, mode='rb'):
+        chunks = self.read_manifest(name)
+        if chunks is None:
+            return super(ChunkedStorage, self)._open(name, mode)
+
+        return File(ChunkedFile(self, chunks), name=name)
+
+    def size(self, name):
+        chunks = self.read_manifest(name)
+        if chunks is None:
+            return super(ChunkedStorage, self).size(name)
+
+        return sum(size for sha256, size in chunks)
+
+# files saved compressing start with a header of HEADER_LENGTH bytes,
+# COMPRESSED_MAGIC and their uncompressed size followed by a gzip
+# stream, or RAW_MAGIC followed by the bytes as they are. Files
+# without a header were stored before compression was enabled.
+HEADER_LENGTH = 64
+COMPRESSED_MAGIC = 'melissi-gzip 1'
+RAW_MAGIC = 'melissi-raw 1'
+
+# types that are compressed already, or do not get much smaller
+INCOMPRESSIBLE_TYPES = ('image/', 'video/', 'audio/',
+                        'application/zip', 'application/x-gzip',
+                        'application/x-bzip2', 'application/x-xz',
+                        'application/x-7z-compressed',
+                        'application/x-rar-compressed', 'application/pdf',
+                        'application/vnd.openxmlformats-officedocument.',
+                        'application/vnd.oasis.opendocument.')
+
+# leading bytes of compressed formats, for content saved under names
+# without an extension: gzip, zip and office documents, bzip2, xz, 7z,
+# rar, png, jpeg, gif, ogg, matroska and webm, pdf
+INCOMPRESSIBLE_SIGNATURES = ('\x1f\x8b', 'PK\x03\x04', 'BZh',
+                             '\xfd7zXZ\x00', '7z\xbc\xaf\x27\x1c',
+                             'Rar!\x1a\x07', '\x89PNG', '\xff\xd8\xff',
+                             'GIF8', 'OggS', '\x1a\x45\xdf\xa3', '%PDF')
+
+class HeaderSkippingFile(object):
+    """
+    Read only file object over the bytes of f after its header
+    """
+    def __init__(self, f, offset=HEADER_LENGTH):
+        self.file = f
+        self.offset = offset
+        self.name = f.name
+        self.file.seek(offset)
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            offset += self.offset
+        self.file.seek(offset, whence)
+        if self.file.tell() < self.offset:
+            self.file.seek(self.offset)
+
+    def tell(self):
+        return self.file.tell() - self.offset
+
+    def close(self):
+        self.file.close()
+
+class CompressingStorageMixin(object):
+    """
+    Storage mixin that gzips files on save and inflates them on open,
+    reporting their uncompressed size. Files that are not compressed,
+    because of their type or because they did not get smaller, are
+    stored as they are behind a header saying so, so that no uploaded
+    bytes are ever taken for a header.
+    """
+    compressed = True
+
+    def compress_level(self, content):
+        """
+        Return the gzip level for content, 0 to store it as it is.
+
+        Stored names have no extension, the type is guessed from the
+        name content was uploaded with and from its first bytes.
+        """
+        content_type = mimetypes.guess_type(getattr(content, 'name', None)
+                                            or '')[0] or ''
+        if content_type.startswith(INCOMPRESSIBLE_TYPES):
+            return 0
+
+        content.seek(0)
+        start = content.read(HEADER_LENGTH)
+        content.seek(0)
+        if start.startswith(INCOMPRESSIBLE_SIGNATURES) or \
+               start[4:8] == 'ftyp':
+            # mp4 and quicktime files have ftyp after the box size
+            return 0
+
+        # text compresses best and is read most
+        if content_type.startswith('text/'):
+            return 9
+
+        return 6
+
+    def _save(self, name, content):
+        if os.path.exists(self.path(name)):
+            return super(CompressingStorageMixin, self)._save(name, content)
+
+        level = self.compress_level(content)
+        tmp = tempfile.TemporaryFile()
+        tmp.write(' ' * HEADER_LENGTH)
+        size = 0
+        if level:
+            gz = gzip.GzipFile(fileobj=tmp, mode='wb', compresslevel=level,
+                               mtime=0)
+            for chunk in content.chunks():
+                gz.write(chunk)
+                size += len(chunk)
+            gz.close()
+
+        if level and tmp.tell() < HEADER_LENGTH + size:
+            header = '%s %d' % (COMPRESSED_MAGIC, size)
+        else:
+            header = RAW_MAGIC
+            tmp.seek(HEADER_LENGTH)
+            tmp.truncate()
+            for chunk in content.chunks():
+                tmp.write(chunk)
+
+        # the header has a fixed length, its size is padded
+        tmp.seek(0)
+        tmp.write(header.ljust(HEADER_LENGTH - 1) + '\n')
+
+        tmp.seek(0, os.SEEK_END)
+        stored = File(tmp)
+        stored.size = tmp.tell()
+        try:
+            return super(CompressingStorageMixin, self)._save(name, stored)
+        finally:
+            tmp.close()
+
+    def _read_header(self, f):
+        """
+        Return the encoding of f, 'gzip', 'raw' or None for files
+        without a header, and its uncompressed size. Sizes are checked
+        against the gzip trailer, so that a header that does not match
+        the stream is not believed.
+        """
+        length = os.fstat(f.fileno()).st_size
+        header = f.read(HEADER_LENGTH)
+        f.seek(0)
+        if len(header) == HEADER_LENGTH and header.endswith('\n'):
+            fields = header.split()
+            if fields == RAW_MAGIC.split():
+                return 'raw', length - HEADER_LENGTH
+
+            if fields[:-1] == COMPRESSED_MAGIC.split() and \
+                   fields[-1].isdigit():
+                size = int(fields[-1])
+                f.seek(-4, os.SEEK_END)
+                trailer = f.read(4)
+                f.seek(0)
+                if len(trailer) == 4 and \
+                       struct.unpack('<I', trailer)[0] == size & 0xffffffff:
+                    return 'gzip', size
+
+        return None, length
+
+    def _open(self, name, mode='rb'):
+        f = open(self.path(name), 'rb')
+        encoding, size = self._read_header(f)
+        if encoding is None:
+            return File(f)
+
+        if encoding == 'gzip':
+            content = File(gzip.GzipFile(fileobj=HeaderSkippingFile(f),
+                                         mode='rb'), name=name)
+        else:
+            content = File(HeaderSkippingFile(f), name=name)
+        content.size = size
+        return content
+
+    def open_encoded(self, name):
+        """
+        Return the gzip stream of name and its length, to send it
+        with Content-Encoding gzip, or None if name is not compressed
+        """
+        f = open(self.path(name), 'rb')
+        if self._read_header(f)[0] != 'gzip':
+            f.close()
+            return None
+
+        f.seek(HEADER_LENGTH)
+        return f, os.path.getsize(self.path(name)) - HEADER_LENGTH
+
+    def size(self, name):
+        f = open(self.path(name), 'rb')
+        try:
+            return self._read_header(f)[1]
+        finally:
+            f.close()
+
+class CompressedStorage(CompressingStorageMixin, ContentAddressedStorage):
+    pass
+
+class CompressedFileSystemStorage(CompressingStorageMixin, FileSystemStorage):
+    pass
+
+if getattr(settings, 'MELISSI_CHUNK_STORE', False):
+    blob_storage = ChunkedStorage(
+        getattr(settings, 'MELISSI_CHUNK_SIZE', 64 * 2 ** 10),
+        location=settings.MELISSI_STORE_LOCATION)
+elif getattr(settings, 'MELISSI_COMPRESS_STORE', False):
+    blob_storage = CompressedStorage(location=settings.MELISSI_STORE_LOCATION)
+else:
+    blob_storage = ContentAddressedStorage(location=settings.MELISSI_STORE_LOCATION)
+
+# patches and reverse deltas
+if getattr(settings, 'MELISSI_COMPRESS_STORE', False):
+    file_storage = CompressedFileSystemStorage(
+        location=settings.MELISSI_STORE_LOCATION)
+else:
+    file_storage = FileSystemStorage(location=settings.MELISSI_STORE_LOCATION)
@@ -1,16 +1,38 @@
+import os
 import base64
+import gzip
+import shutil
+import hashlib
 import tempfile
 import json
 import time
+import threading
 from datetime import datetime, timedelta
+from StringIO import StringIO
 
 from django.test import TestCase
-from django.test.client import Client
+from django.test.client import Client, RequestFactory
 from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db.models.fields.files import FieldFile
+from django.core.files.uploadhandler import StopFutureHandlers
+from django.conf import settings
+from django.db import transaction
+from django.core.management import call_command
 
 from piston.decorator import decorator
+import librsync
 
 from models import *
+import models as mls_models
+from storage import calculate_blob_path, calculate_signature_path,\
+     calculate_delta_cache_path, calculate_sharded_path, ChunkedStorage,\
+     CompressedFileSystemStorage, split_chunks, MANIFEST_MAGIC
+import common
+import notify
+from management.commands import mls_chunk, mls_relocate
+from uploadhandlers import HashingMemoryFileUploadHandler,\
+     HashingTemporaryFileUploadHandler
 
 def make_droplet(*args, **kwargs):
     """
@@ -669,6 +691,123 @@ class DropletTest(AuthTestCase):
 
         return dic
 
+    @test_multiple_users
+    def test_patch_droplet(self):
+        """
+        Test posting only a patch to a droplet
+        """
+        base = tempfile.NamedTemporaryFile()
+        base.write('12345')
+        content = tempfile.NamedTemporaryFile()
+        content.write('56789')
+        patch = tempfile.NamedTemporaryFile()
+
+        base.seek(0)
+        content.seek(0)
+        patch.write(librsync.DeltaFile(librsync.SignatureFile(base),
+                                       content).read())
+
+        def setup():
+            u = self.users['owner']['object']
+            c = u.cell_set.all()[0]
+
+            d = make_droplet(owner=u, name="test", cell=c)
+
+            patch.seek(0)
+            return {'d_id': d.id}
+
+        def extra_checks(response):
+            d = Droplet.objects.get(name="test")
+            self.assertEqual(d.content.read(), '56789')
+            self.assertEqual(d.content_sha256, 'f76043a74ec33b6aefbb289050faf7aa8d482095477397e3e63345125d49f527')
+            self.assertTrue(d.patch)
+
+        dic = {
+            'setup': setup,
+            'teardown': self.teardown,
+            'response_code': {'user': 401,
+                              'admin': 401,
+                              'anonymous':401,
+                              'owner': 200,
+                              },
+            'postdata': {
+                "patch":patch,
+                "content_sha256":'f76043a74ec33b6aefbb289050faf7aa8d482095477397e3e63345125d49f527',
+                "number":2,
+                },
+            'method':'post',
+            'url': '/api/droplet/%(d_id)s/revision/',
+            'users': self.users,
+            'checks' : { 'owner': extra_checks }
+            }
+
+        return dic
+
+    @test_multiple_users
+    def test_create_droplet_batch(self):
+        """
+        Test creating many droplets with one request
+        """
+        u = self.users['owner']['object']
+        c = u.cell_set.all()[0]
+
+        contents = []
+        for data in ('12345', '56789'):
+            content = tempfile.NamedTemporaryFile()
+            content.write(data)
+            contents.append(content)
+
+        def setup():
+            for content in contents:
+                content.seek(0)
+
+        def extra_checks(response):
+            reply = json.loads(response.content)['reply']
+            self.assertEqual([d['name'] for d in reply], ['foo', 'bar'])
+            self.assertEqual(c.droplet_set.count(), 2)
+            self.assertEqual(Droplet.objects.get(name="bar").content.read(),
+                             '56789')
+            self.assertEqual(UserProfile.objects.get(user=u).personal_quota,
+                             10)
+
+        dic = {
+            'setup': setup,
+            'teardown': self.teardown,
+            'response_code': {'user': 401,
+                              'admin': 401,
+                              'anonymous':401,
+                              'owner': 200,
+                              },
+            'postdata': {
+                'name': ['foo', 'bar'],
+                'cell': [c.id, c.id],
+                'content_sha256': ['5994471abb01112afcc18159f6cc74b4f511b99806da59b3caf5a9c173cacfc5',
+                                   'f76043a74ec33b6aefbb289050faf7aa8d482095477397e3e63345125d49f527'],
+                'content': contents,
+                },
+            'method':'post',
+            'url': '/api/droplet/batch/',
+            'users': self.users,
+            'checks' : { 'owner': extra_checks }
+            }
+
+        return dic
+
+    def test_create_droplet_batch_bad_cell(self):
+        """
+        Test that a batch with a malformed cell id is rejected
+        """
+        owner = self.users['owner']
+        c = owner['object'].cell_set.all()[0]
+
+        response = self.client.post('/api/droplet/batch/',
+                                    {'name': ['foo', 'bar'],
+                                     'cell': [c.id, 'foo'],
+                                     'content_sha256': ['0' * 64, '0' * 64]},
+                                    **owner['auth'])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(c.droplet_set.count(), 0)
+
     @test_multiple_users
     def test_revision_conflict(self):
         def setup():
@@ -689,6 +828,8 @@ class DropletTest(AuthTestCase):
             self.assertNotEqual(d, d1)
             self.assertEqual(d.dropletrevision_set.count(), 2)
             self.assertEqual(d1.dropletrevision_set.count(), 2)
+            self.assertEqual(d.revisions, 2)
+            self.assertEqual(d1.revisions, 2)
 
         dic = {
             'setup': setup,
@@ -765,6 +906,7 @@ class DropletTest(AuthTestCase):
 
         def extra_checks(response):
             self.assertEqual(Droplet.objects.filter(name="test").count(), 1)
+            self.assertEqual(Droplet.objects.get(name="test").revisions, 1)
 
         dic = {
             'setup': setup,
@@ -848,6 +990,158 @@ class DropletTest(AuthTestCase):
 
         return dic
 
+    def test_read_droplet_content_range(self):
+        """
+        Test conditional and partial downloads of droplet content
+        """
+        u = self.users['owner']['object']
+        d = make_droplet(owner=u, name="test", cell=u.cell_set.all()[0])
+        url = '/api/droplet/%s/revision/latest/content/' % d.id
+        auth = self.users['owner']['auth']
+
+        response = self.client.get(url, **auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], '"%s"' % d.content_sha256)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'],
+                                   **auth)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=1-2', **auth)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 1-2/5')
+        self.assertEqual(''.join(response), '23')
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-2', **auth)
+        self.assertEqual(''.join(response), '45')
+
+        # a changed copy gets the whole file
+        response = self.client.get(url, HTTP_RANGE='bytes=1-2',
+                                   HTTP_IF_RANGE='"foo"', **auth)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(url, HTTP_RANGE='bytes=5-', **auth)
+        self.assertEqual(response.status_code, 416)
+
+        # no last bytes of an empty file
+        request = RequestFactory().get(url, HTTP_RANGE='bytes=-2')
+        self.assertRaises(ValueError, common._byte_range, request, 0, None)
+
+    def test_read_droplet_signature(self):
+        """
+        Test that revision signatures are served and cached
+        """
+        u = self.users['owner']['object']
+        d = make_droplet(owner=u, name="test", cell=u.cell_set.all()[0])
+        d.dropletrevision_set.add(DropletRevision(number=2, name="foo",
+                                  resource=u.userresource_set.all()[0]))
+        auth = self.users['owner']['auth']
+
+        f = tempfile.TemporaryFile()
+        f.write('12345')
+        f.seek(0)
+        signature = librsync.SignatureFile(f).read()
+
+        for url in ('/api/droplet/%s/revision/2/signature/' % d.id,
+                    '/api/droplet/%s/revision/latest/signature/' % d.id):
+            response = self.client.get(url, **auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(''.join(response), signature)
+            self.assertEqual(response['ETag'], '"%s"' % d.content_sha256)
+
+        self.assertTrue(os.path.exists(os.path.join(
+            settings.MELISSI_STORE_LOCATION,
+            calculate_signature_path(d.content_sha256))))
+
+    def test_read_droplet_delta(self):
+        """
+        Test that deltas between revisions are served and cached
+        """
+        u = self.users['owner']['object']
+        d = make_droplet(owner=u, name="test", cell=u.cell_set.all()[0])
+        base_sha256 = d.content_sha256
+
+        f = tempfile.NamedTemporaryFile()
+        f.write('56789')
+        f.seek(0)
+        r = DropletRevision(number=2,
+                            content_sha256='f76043a74ec33b6aefbb289050faf7aa8d482095477397e3e63345125d49f527',
+                            resource=u.userresource_set.all()[0])
+        r.content.save('foo', File(f), save=False)
+        d.dropletrevision_set.add(r)
+        auth = self.users['owner']['auth']
+
+        url = '/api/droplet/%s/revision/latest/delta/' % d.id
+        for query in ('?from=1', '?from_sha256=%s' % base_sha256):
+            response = self.client.get(url + query, **auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['ETag'], '"%s-%s"' % (base_sha256,
+                                                            r.content_sha256))
+
+            base = tempfile.TemporaryFile()
+            base.write('12345')
+            base.seek(0)
+            delta = tempfile.TemporaryFile()
+            delta.write(''.join(response))
+            delta.seek(0)
+            self.assertEqual(librsync.PatchedFile(base, delta).read(), '56789')
+
+        self.assertTrue(os.path.exists(os.path.join(
+            settings.MELISSI_STORE_LOCATION,
+            calculate_delta_cache_path(base_sha256, r.content_sha256))))
+
+        response = self.client.get(url, **auth)
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url + '?from_sha256=foo', **auth)
+        self.assertEqual(response.status_code, 404)
+
+    def test_create_droplet_resumable(self):
+        """
+        Test creating a droplet from content uploaded in chunks
+        """
+        u = self.users['owner']['object']
+        auth = self.users['owner']['auth']
+
+        response = self.client.post('/api/upload/', {}, **auth)
+        self.assertEqual(response.status_code, 200)
+        upload_id = json.loads(response.content)['reply']['id']
+        url = '/api/upload/%s/' % upload_id
+
+        for offset, data in ((0, '123'), (3, '4'), (2, '345')):
+            response = self.client.put('%s?offset=%s' % (url, offset), data,
+                                       content_type='application/octet-stream',
+                                       **auth)
+            self.assertEqual(response.status_code, 200)
+
+        for offset in (9, -1):
+            response = self.client.put('%s?offset=%s' % (url, offset), '6',
+                                       content_type='application/octet-stream',
+                                       **auth)
+            self.assertEqual(response.status_code, 400)
+
+        # chunks are never parsed, whatever their content type
+        response = self.client.put('%s?offset=5' % url, '\x00{',
+                                   content_type='application/json', **auth)
+        self.assertEqual(response.status_code, 200)
+        response = self.client.put('%s?offset=5' % url, '',
+                                   content_type='application/octet-stream',
+                                   **auth)
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(url, **auth)
+        self.assertEqual(json.loads(response.content)['reply']['size'], 5)
+
+        response = self.client.post('/api/droplet/',
+                                    {'upload': upload_id,
+                                     'name': 'test',
+                                     'cell': u.cell_set.all()[0].id,
+                                     'content_sha256': '5994471abb01112afcc18159f6cc74b4f511b99806da59b3caf5a9c173cacfc5'},
+                                    **auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Droplet.objects.get(name="test").content.read(),
+                         '12345')
+        self.assertEqual(UploadSession.objects.count(), 0)
+
 class ShareTest(AuthTestCase):
     def setUp(self):
         self.users = {
@@ -1064,6 +1358,46 @@ class ShareTest(AuthTestCase):
 
         return dic
 
+    @test_multiple_users
+    def test_read_shared_subcell(self):
+        """
+        Read a droplet deep inside a shared tree
+        """
+        def setup():
+            u = self.users['owner']['object']
+            c = u.cell_set.all()[0]
+            c1 = Cell(owner=u,
+                      parent=c,
+                      name="foo")
+            c1.save()
+            c2 = Cell(owner=u,
+                      parent=c1,
+                      name="bar")
+            c2.save()
+            d = make_droplet(owner=u, cell=c2, name="foo")
+
+            c1.share_set.add(Share(user=self.users['user']['object'],
+                                   mode=2))
+
+            return {'d_id': d.id }
+
+        dic = {
+            'setup': setup,
+            'teardown': self.teardown,
+            'response_code': {'user': 200,
+                              'admin': 401,
+                              'anonymous':401,
+                              'owner': 200,
+                              },
+            'postdata': {
+                },
+            'method':'get',
+            'url': '/api/droplet/%(d_id)s/',
+            'users': self.users,
+            }
+
+        return dic
+
     # @test_multiple_users
     # def test_recursive_share_cell(self):
     #     """
@@ -1225,6 +1559,50 @@ class StatusTest(AuthTestCase):
 
         return dic
 
+    def test_read_status_all_pages(self):
+        """
+        Read status of user, all entries, two at a time
+        """
+        owner = self.users['owner']['object']
+        user = self.users['user']['object']
+
+        c = owner.cell_set.all()[0]
+        c1 = Cell(owner=owner,
+                  parent=c,
+                  name="foo")
+        c1.save()
+        c1.share_set.add(Share(user=user, mode=1))
+        make_droplet(owner=owner, cell=c1, name="foo")
+
+        c2 = Cell(owner=user,
+                  parent=user.cell_set.all()[0],
+                  name="bar")
+        c2.save()
+        make_droplet(owner=owner, cell=c2, name="foo1")
+
+        cells = []
+        droplets = []
+        url = '/api/status/all/?limit=2'
+        while url:
+            response = self.client.get(url, **self.users['user']['auth'])
+            self.assertEqual(response.status_code, 200)
+
+            reply = json.loads(response.content)['reply']
+            self.assertTrue(len(reply['cells']) + len(reply['droplets']) <= 2)
+            cells.extend(cell['id'] for cell in reply['cells'])
+            droplets.extend(droplet['id'] for droplet in reply['droplets'])
+
+            url = reply['next'] and \
+                  '/api/status/all/?limit=2&after=%s' % reply['next']
+
+        self.assertEqual(len(set(cells)), 3)
+        self.assertEqual(len(cells), 3)
+        self.assertEqual(len(droplets), 2)
+
+        response = self.client.get('/api/status/all/?after=x',
+                                   **self.users['user']['auth'])
+        self.assertEqual(response.status_code, 400)
+
     @test_multiple_users
     def test_read_status_timestamp(self):
         """
@@ -1330,6 +1708,1105 @@ class StatusTest(AuthTestCase):
         return dic
 
 
+    @test_multiple_users
+    def test_read_status_changes(self):
+        """
+        Read status of user, with journal cursor
+        """
+        def setup():
+            owner = self.users['owner']['object']
+            user = self.users['user']['object']
+
+            c = owner.cell_set.all()[0]
+            c1 = Cell(owner=owner,
+                      parent=c,
+                      name="foo")
+            c1.save()
+            c1.share_set.add(Share(user=user, mode=1))
+            d = make_droplet(owner=owner, cell=c1, name="foo")
+            d.save()
+
+            cursor = Change.latest_id()
+            c2 = Cell(owner=user,
+                      parent=user.cell_set.all()[0],
+                      name="bar")
+            c2.save()
+            d1 = make_droplet(owner=owner, cell=c2, name="foo1")
+            d1.save()
+
+            return {'c1_id': c1.id, 'cursor': cursor }
+
+        def extra_checks(response):
+            response = json.loads(response.content)
+            self.assertEqual(len(response['reply']['cells']), 1)
+            self.assertEqual(len(response['reply']['droplets']), 1)
+            self.assertEqual(response['reply']['cursor'], Change.latest_id())
+
+        dic = {
+            'setup': setup,
+            'teardown': self.teardown,
+            'response_code': {'user': 200,
+                              'admin': 200,
+                              'anonymous':401,
+                              'owner': 200,
+                              },
+            'postdata': {
+                },
+            'method':'get',
+            'url': '/api/status/changes/%(cursor)s/',
+            'users': self.users,
+            'checks' : { 'user': extra_checks }
+            }
+
+        return dic
+
+    @test_multiple_users
+    def test_read_status_changes_share(self):
+        """
+        Read status of user, with journal cursor
+        Adding a share after cursor
+        """
+        def setup():
+            owner = self.users['owner']['object']
+            user = self.users['user']['object']
+
+            c = owner.cell_set.all()[0]
+            c1 = Cell(owner=owner,
+                      parent=c,
+                      name="foo")
+            c1.save()
+            d = make_droplet(owner=owner, cell=c1, name="foo")
+            d.save()
+
+            cursor = Change.latest_id()
+            c2 = Cell(owner=user,
+                      parent=user.cell_set.all()[0],
+                      name="bar")
+            c2.save()
+            d1 = make_droplet(owner=owner, cell=c2, name="foo1")
+            d1.save()
+
+            c1.share_set.add(Share(user=user, mode=1))
+
+            return {'c1_id': c1.id, 'cursor': cursor }
+
+        def extra_checks(response):
+            response = json.loads(response.content)
+            self.assertEqual(len(response['reply']['cells']), 2)
+            self.assertEqual(len(response['reply']['droplets']), 2)
+
+        def owner_checks(response):
+            response = json.loads(response.content)
+            self.assertEqual(len(response['reply']['cells']), 1)
+            self.assertEqual(len(response['reply']['droplets']), 0)
+
+        dic = {
+            'setup': setup,
+            'teardown': self.teardown,
+            'response_code': {'user': 200,
+                              'admin': 200,
+                              'anonymous':401,
+                              'owner': 200,
+                              },
+            'postdata': {
+                },
+            'method':'get',
+            'url': '/api/status/changes/%(cursor)s/',
+            'users': self.users,
+            'checks' : { 'user': extra_checks,
+                         'owner': owner_checks }
+            }
+
+        return dic
+
+    @test_multiple_users
+    def test_read_status_changes_share_ancestor(self):
+        """
+        Read status of user, with journal cursor
+        Deleting a cell above a share after cursor
+        """
+        def setup():
+            owner = self.users['owner']['object']
+            user = self.users['user']['object']
+
+            c = owner.cell_set.all()[0]
+            c1 = Cell(owner=owner,
+                      parent=c,
+                      name="foo")
+            c1.save()
+            c2 = Cell(owner=owner,
+                      parent=c1,
+                      name="bar")
+            c2.save()
+            make_droplet(owner=owner, cell=c1, name="foo").save()
+            make_droplet(owner=owner, cell=c2, name="bar").save()
+            c2.share_set.add(Share(user=user, mode=1))
+
+            cursor = Change.latest_id()
+            Cell.objects.get(pk=c1.pk).set_deleted()
+
+            return {'cursor': cursor }
+
+        def extra_checks(response):
+            response = json.loads(response.content)
+            self.assertEqual([cell['name'] for cell in
+                              response['reply']['cells']], ['bar'])
+            self.assertEqual([droplet['name'] for droplet in
+                              response['reply']['droplets']], ['bar'])
+
+        def owner_checks(response):
+            response = json.loads(response.content)
+            self.assertEqual(len(response['reply']['cells']), 2)
+            self.assertEqual(len(response['reply']['droplets']), 2)
+
+        dic = {
+            'setup': setup,
+            'teardown': self.teardown,
+            'response_code': {'user': 200,
+                              'admin': 200,
+                              'anonymous':401,
+                              'owner': 200,
+                              },
+            'postdata': {
+                },
+            'method':'get',
+            'url': '/api/status/changes/%(cursor)s/',
+            'users': self.users,
+            'checks' : { 'user': extra_checks,
+                         'owner': owner_checks }
+            }
+
+        return dic
+
+    @test_multiple_users
+    def test_read_status_changes_share_update(self):
+        """
+        Read status of user, with journal cursor
+        Renaming a share after cursor
+        """
+        def setup():
+            owner = self.users['owner']['object']
+            user = self.users['user']['object']
+
+            c = owner.cell_set.all()[0]
+            c1 = Cell(owner=owner,
+                      parent=c,
+                      name="foo")
+            c1.save()
+            make_droplet(owner=owner, cell=c1, name="foo").save()
+            c1.share_set.add(Share(user=user, mode=1))
+
+            cursor = Change.latest_id()
+            share = c1.share_set.get(user=user)
+            share.name = "bar"
+            share.save()
+
+            return {'cursor': cursor }
+
+        def extra_checks(response):
+            response = json.loads(response.content)
+            self.assertEqual([cell['name'] for cell in
+                              response['reply']['cells']], ['bar'])
+            self.assertEqual(len(response['reply']['droplets']), 1)
+
+        dic = {
+            'setup': setup,
+            'teardown': self.teardown,
+            'response_code': {'user': 200,
+                              'admin': 200,
+                              'anonymous':401,
+                              'owner': 200,
+                              },
+            'postdata': {
+                },
+            'method':'get',
+            'url': '/api/status/changes/%(cursor)s/',
+            'users': self.users,
+            'checks' : { 'user': extra_checks }
+            }
+
+        return dic
+
+
+    def test_read_status_queries(self):
+        """
+        Test that status replies cost the same queries for any number
+        of cells and droplets
+        """
+        owner = self.users['owner']
+        root = owner['object'].cell_set.all()[0]
+        cursor = Change.latest_id()
+
+        def read(url):
+            # replies are streamed, read them whole
+            return ''.join(self.client.get(url, **owner['auth']))
+
+        for i in range(3):
+            c = Cell.objects.create(owner=owner['object'], name="c%s" % i,
+                                    parent=root)
+            make_droplet(owner=owner['object'], name="d%s" % i, cell=c)
+
+            for url, queries in (('/api/status/all/', 6),
+                                 ('/api/status/after/%s/' % (time.time() - 60), 6),
+                                 ('/api/status/changes/%s/' % cursor, 10)):
+                # warm up the authentication cache first
+                read(url)
+                self.assertNumQueries(queries, read, url)
+
+    def test_wait_status_changes(self):
+        """
+        Test that waiting for changes returns them, or times out
+        """
+        user = self.users['user']
+        cursor = Change.latest_id()
+        url = '/api/status/wait/%s/' % cursor
+
+        start = time.time()
+        response = self.client.get(url, {'timeout': 0.2}, **user['auth'])
+        self.assertTrue(time.time() - start >= 0.2)
+        self.assertEqual(json.loads(response.content)['reply']['cells'], [])
+
+        for timeout in ('nan', 'inf', 'foo'):
+            response = self.client.get(url, {'timeout': timeout},
+                                       **user['auth'])
+            self.assertEqual(response.status_code, 400)
+
+        Cell.objects.create(owner=user['object'], name="bar",
+                            parent=user['object'].cell_set.all()[0])
+        response = self.client.get(url, **user['auth'])
+        reply = json.loads(response.content)['reply']
+        self.assertEqual(len(reply['cells']), 1)
+        self.assertEqual(reply['cursor'], Change.latest_id())
+
+    def test_read_status_late_commit(self):
+        """
+        Test that entries committed after a cursor was handed out are
+        reported, even with a lower id
+        """
+        owner = self.users['owner']
+        root = owner['object'].cell_set.all()[0]
+        url = '/api/status/changes/%s/'
+
+        late = Cell.objects.create(owner=owner['object'], name="late",
+                                   parent=root)
+        Cell.objects.create(owner=owner['object'], name="early", parent=root)
+        cursor = Change.latest_id()
+
+        # as if the transaction writing late committed only now
+        Change.objects.filter(cell=late).update(sequence=None)
+
+        response = self.client.get(url % cursor, **owner['auth'])
+        reply = json.loads(response.content)['reply']
+        self.assertEqual([c['name'] for c in reply['cells']], [u'late'])
+        self.assertTrue(reply['cursor'] > cursor)
+
+    def test_read_status_unshared(self):
+        """
+        Test that unsharing a cell is reported to the user
+        """
+        owner = self.users['owner']['object']
+        user = self.users['user']
+        c = Cell.objects.create(owner=owner, name="foo",
+                                parent=owner.cell_set.all()[0])
+        share = Share.objects.create(cell=c, user=user['object'])
+        cursor = Change.latest_id()
+
+        share.delete()
+
+        response = self.client.get('/api/status/changes/%s/' % cursor,
+                                   **user['auth'])
+        reply = json.loads(response.content)['reply']
+        self.assertEqual(reply['unshared'], [c.pk])
+        self.assertEqual(reply['cells'], [])
+        self.assertTrue(Change.objects.filter(cell=c, user=user['object'],
+                                              unshared=False).exists())
+
+    def test_notify(self):
+        """
+        Test that the notification bus wakes up waiters
+        """
+        user = self.users['user']['object']
+        old_token = notify.token(user.id)
+        with transaction.commit_on_success():
+            cell = Cell.objects.create(owner=user, name="bar",
+                                       parent=user.cell_set.all()[0])
+
+            # nothing is sent before the transaction commits
+            self.assertEqual(notify.token(user.id), old_token)
+
+        # as NotifyMiddleware does after the request
+        notify.flush()
+        token = notify.token(user.id)
+        self.assertEqual(token, str(Change.objects.latest('id').id))
+
+        self.assertFalse(notify.wait(user.id, token, 0.1))
+
+        threading.Timer(0.1, notify.notify, ([user.id], 'foo')).start()
+        self.assertTrue(notify.wait(user.id, token, 5, 0.05))
+        self.assertEqual(notify.token(user.id), 'foo')
+
+class BlobTest(AuthTestCase):
+    def setUp(self):
+        self.users = {
+            'owner': self.create_user("foo", "foo@example.com"),
+            'user': self.create_user(),
+            }
+
+    def test_deduplicate_content(self):
+        """
+        Test that identical contents share one blob
+        """
+        owner = self.users['owner']['object']
+        user = self.users['user']['object']
+
+        d = make_droplet(owner=owner, name="foo", cell=owner.cell_set.all()[0])
+        d1 = make_droplet(owner=user, name="bar", cell=user.cell_set.all()[0])
+
+        self.assertEqual(d.content.name, d1.content.name)
+        self.assertEqual(d.content.name,
+                         calculate_blob_path(d.content_sha256))
+        self.assertEqual(Blob.objects.get(sha256=d.content_sha256).refcount, 2)
+
+    def test_collect_garbage(self):
+        """
+        Test that blobs are removed only when no revision references them
+        """
+        owner = self.users['owner']['object']
+
+        d = make_droplet(owner=owner, name="foo", cell=owner.cell_set.all()[0])
+        path = d.content.path
+
+        self.assertEqual(Blob.collect_garbage(timedelta(0)), 0)
+        self.assertTrue(os.path.exists(path))
+
+        d.delete()
+        self.assertEqual(Blob.objects.get(sha256=d.content_sha256).refcount, 0)
+
+        # just uploaded blobs are kept during the grace period
+        Blob.collect_garbage()
+        self.assertTrue(os.path.exists(path))
+
+        # the bytes on disk, compressed files have a header
+        size = os.path.getsize(path)
+        os.utime(path, (0, 0))
+        self.assertEqual(Blob.collect_garbage(timedelta(0)), size)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(Blob.objects.count(), 0)
+
+    def test_verify_once(self):
+        """
+        Test that content is hashed once, however often it is saved
+        """
+        owner = self.users['owner']['object']
+        hashed = []
+
+        def counting_sha256(content):
+            hashed.append(content.name)
+            return calculate_sha256(content)
+
+        mls_models.calculate_sha256 = counting_sha256
+        try:
+            f = tempfile.NamedTemporaryFile()
+            f.write('12345')
+            f.seek(0)
+
+            # like a form validating before saving
+            d = Droplet(name="foo", owner=owner, cell=owner.cell_set.all()[0],
+                        content=File(f, name="foo"),
+                        content_sha256='5994471abb01112afcc18159f6cc74b4f511b99806da59b3caf5a9c173cacfc5')
+            d.clean()
+            d.save()
+            f.close()
+            self.assertEqual(len(hashed), 1)
+
+            # content stored before the blob store is verified once
+            # too, when saved
+            rev = d.dropletrevision_set.get()
+            name = mls_models.blob_storage.save('legacy', rev.content)
+            DropletRevision.objects.filter(pk=rev.pk).update(content=name)
+            Blob.remove_reference(rev.content_sha256)
+
+            rev = DropletRevision.objects.get(pk=rev.pk)
+            rev.resource = owner.userresource_set.all()[0]
+            rev.save()
+            rev.save()
+            self.assertEqual(len(hashed), 1)
+
+        finally:
+            mls_models.calculate_sha256 = calculate_sha256
+
+    def test_purge(self):
+        """
+        Test that the purge command removes old deleted items and
+        orphaned files, keeping history of items that moved out
+        """
+        owner = self.users['owner']['object']
+        root = owner.cell_set.all()[0]
+
+        c = Cell.objects.create(owner=owner, name="trash", parent=root)
+        make_droplet(owner=owner, name="foo", cell=c)
+        d = make_droplet(owner=owner, name="bar", cell=c)
+        d.dropletrevision_set.add(DropletRevision(number=2, cell=root,
+                                  resource=owner.userresource_set.all()[0]))
+        Cell.objects.get(pk=c.pk).set_deleted()
+
+        orphan = os.path.join(settings.MELISSI_STORE_LOCATION, 'orphan')
+        f = open(orphan, 'wb')
+        f.write('123')
+        f.close()
+        os.utime(orphan, (0, 0))
+
+        # content under a legacy name and notification tokens are
+        # no orphans
+        kept = make_droplet(owner=owner, name="kept", cell=root)
+        rev = kept.dropletrevision_set.get()
+        legacy = mls_models.blob_storage.save(str(kept.pk), rev.content)
+        DropletRevision.objects.filter(pk=rev.pk).update(content=legacy)
+        Droplet.objects.filter(pk=kept.pk).update(content=legacy)
+        Blob.remove_reference(rev.content_sha256)
+        notify.notify([owner.id], 'foo')
+        kept_files = [os.path.join(settings.MELISSI_STORE_LOCATION, legacy),
+                      notify._path(owner.id)]
+        for path in kept_files:
+            os.utime(path, (0, 0))
+
+        out = StringIO()
+        call_command('mls_purge', days=0, grace=0, stdout=out)
+
+        self.assertFalse(Cell.objects.filter(pk=c.pk).exists())
+        self.assertEqual(list(Droplet.objects.exclude(pk=kept.pk).\
+                              values_list('name', flat=True)), [u'bar'])
+        self.assertEqual(DropletRevision.objects.filter(droplet=d).count(), 2)
+        self.assertFalse(os.path.exists(orphan))
+        for path in kept_files:
+            self.assertTrue(os.path.exists(path))
+        self.assertTrue("Purged 1 droplets, 1 cells" in out.getvalue())
+
+    def test_relocate(self):
+        """
+        Test that the relocate command moves patches and deltas into
+        the sharded layout and legacy content into the blob store
+        """
+        owner = self.users['owner']['object']
+        d = make_droplet(owner=owner, name="foo", cell=owner.cell_set.all()[0])
+        rev = d.dropletrevision_set.get()
+
+        content = mls_models.blob_storage.save(str(d.pk), rev.content)
+        patch = mls_models.file_storage.save(str(d.pk), ContentFile('patch'))
+        delta = mls_models.file_storage.save(
+            os.path.join('deltas', str(d.pk), '1'), ContentFile('delta'))
+        DropletRevision.objects.filter(pk=rev.pk).update(content=content,
+                                                         patch=patch,
+                                                         delta=delta)
+        Droplet.objects.filter(pk=d.pk).update(content=content, patch=patch)
+        Blob.remove_reference(rev.content_sha256)
+
+        # files stay where the rows say until they are committed
+        def failing_rename(command, field, old, new):
+            if field == 'delta':
+                raise IOError
+            _rename(command, field, old, new)
+        directory = mls_models.file_storage.path(
+            os.path.dirname(calculate_sharded_path('patches', d.pk, 1)))
+        listing = lambda: os.path.exists(directory) and os.listdir(directory)
+        before = listing()
+        _rename = mls_relocate.Command._rename.im_func
+        mls_relocate.Command._rename = failing_rename
+        try:
+            self.assertRaises(IOError, call_command, 'mls_relocate')
+        finally:
+            mls_relocate.Command._rename = _rename
+        for name in (content, patch, delta):
+            self.assertTrue(mls_models.file_storage.exists(name))
+        self.assertEqual(listing() or [], before or [])
+
+        out = StringIO()
+        call_command('mls_relocate', stdout=out)
+
+        rev = DropletRevision.objects.get(pk=rev.pk)
+        d = Droplet.objects.get(pk=d.pk)
+        self.assertEqual(rev.content.name, calculate_blob_path(rev.content_sha256))
+        self.assertEqual(d.content.name, rev.content.name)
+        self.assertEqual(Blob.objects.get(sha256=rev.content_sha256).refcount, 1)
+        self.assertEqual(rev.patch.name,
+                         calculate_sharded_path('patches', d.pk, 1))
+        self.assertEqual(d.patch.name, rev.patch.name)
+        self.assertEqual(rev.patch.read(), 'patch')
+        self.assertEqual(rev.delta.name,
+                         calculate_sharded_path('deltas', d.pk, 1))
+        for name in (content, patch, delta):
+            self.assertFalse(mls_models.file_storage.exists(name))
+        self.assertTrue("Relocated 3 files, 0 failed" in out.getvalue())
+
+    def test_droplet_patch_path(self):
+        """
+        Test that patches of new droplets are stored under their id
+        """
+        owner = self.users['owner']['object']
+        cell = owner.cell_set.all()[0]
+        source = make_droplet(owner=owner, name="foo", cell=cell)
+
+        d = Droplet(name="bar", owner=owner, cell=cell,
+                    content=source.content.name,
+                    content_sha256=source.content_sha256)
+        patch = ContentFile('patch')
+        patch.name = 'bar'
+        d.patch = patch
+        d.save()
+        rev = d.dropletrevision_set.get()
+        self.assertTrue(rev.patch.name.startswith(
+            calculate_sharded_path('patches', d.pk, 1)))
+        self.assertEqual(Droplet.objects.get(pk=d.pk).patch.name,
+                         rev.patch.name)
+
+        # droplets are saved before a patch is stored on its own
+        d = Droplet(name="baz", owner=owner, cell=cell,
+                    content=source.content.name,
+                    content_sha256=source.content_sha256)
+        self.assertRaises(Exception, d.patch.save, 'baz', ContentFile('patch'))
+        d.save()
+        d.patch.save('baz', ContentFile('patch'))
+        self.assertEqual(Droplet.objects.filter(name="baz").count(), 1)
+        self.assertTrue(Droplet.objects.get(pk=d.pk).patch.name.startswith(
+            calculate_sharded_path('patches', d.pk, 1)))
+
+class ReverseDeltaTest(AuthTestCase):
+    def setUp(self):
+        self.users = {
+            'owner': self.create_user("foo", "foo@example.com"),
+            }
+        settings.MELISSI_REVERSE_DELTAS = True
+
+    def tearDown(self):
+        settings.MELISSI_REVERSE_DELTAS = False
+
+    def test_reverse_delta(self):
+        """
+        Test that old content is kept as a delta and rebuilt on demand
+        """
+        owner = self.users['owner']['object']
+
+        d = make_droplet(owner=owner, name="foo", cell=owner.cell_set.all()[0])
+
+        f = tempfile.NamedTemporaryFile()
+        f.write('56789')
+        f.seek(0)
+        r = DropletRevision(number=2,
+                            content_sha256='f76043a74ec33b6aefbb289050faf7aa8d482095477397e3e63345125d49f527',
+                            resource=owner.userresource_set.all()[0])
+        r.content.save('foo', File(f), save=False)
+        d.dropletrevision_set.add(r)
+
+        first = d.dropletrevision_set.get(number=1)
+        self.assertFalse(first.content)
+        self.assertEqual(first.delta_base, r)
+        self.assertEqual(Blob.objects.get(sha256=first.content_sha256).refcount, 0)
+
+        response = self.client.get('/api/droplet/%s/revision/1/content/' % d.id,
+                                   **self.users['owner']['auth'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join(response), '12345')
+
+        # deleting the base brings the full content back
+        r.delete()
+        first = d.dropletrevision_set.get(number=1)
+        self.assertEqual(first.content.read(), '12345')
+        self.assertFalse(first.delta)
+        self.assertEqual(Blob.objects.get(sha256=first.content_sha256).refcount, 1)
+        self.assertEqual(Droplet.objects.get(pk=d.pk).content.read(), '12345')
+
+    def test_legacy_content(self):
+        """
+        Test that content under a legacy name kept as a delta leaves
+        the reference of identical content in the blob store alone
+        """
+        owner = self.users['owner']['object']
+        cell = owner.cell_set.all()[0]
+
+        stored = make_droplet(owner=owner, name="foo", cell=cell)
+        d = make_droplet(owner=owner, name="bar", cell=cell)
+        first = d.dropletrevision_set.get()
+        legacy = mls_models.file_storage.save(str(d.pk), first.content)
+        DropletRevision.objects.filter(pk=first.pk).update(content=legacy)
+        Blob.remove_reference(first.content_sha256)
+        self.assertEqual(Blob.objects.get(sha256=first.content_sha256).refcount, 1)
+
+        f = tempfile.NamedTemporaryFile()
+        f.write('56789')
+        f.seek(0)
+        r = DropletRevision(number=2,
+                            content_sha256='f76043a74ec33b6aefbb289050faf7aa8d482095477397e3e63345125d49f527',
+                            resource=owner.userresource_set.all()[0])
+        r.content.save('foo', File(f), save=False)
+        Droplet.objects.get(pk=d.pk).dropletrevision_set.add(r)
+
+        self.assertFalse(d.dropletrevision_set.get(number=1).content)
+        self.assertEqual(Blob.objects.get(sha256=first.content_sha256).refcount, 1)
+        self.assertEqual(Blob.collect_garbage(timedelta(0)), 0)
+        self.assertEqual(Droplet.objects.get(pk=stored.pk).content.read(),
+                         '12345')
+
+    def test_fork(self):
+        """
+        Test that conflict forks share the revision history and its
+        deltas without breaking either droplet
+        """
+        owner = self.users['owner']['object']
+        profile = UserProfile.objects.get(user=owner)
+
+        d = make_droplet(owner=owner, name="foo", cell=owner.cell_set.all()[0])
+
+        f = tempfile.NamedTemporaryFile()
+        f.write('56789')
+        f.seek(0)
+        r = DropletRevision(number=2,
+                            content_sha256='f76043a74ec33b6aefbb289050faf7aa8d482095477397e3e63345125d49f527',
+                            resource=owner.userresource_set.all()[0])
+        r.content.save('foo', File(f), save=False)
+        d.dropletrevision_set.add(r)
+        d.dropletrevision_set.add(DropletRevision(number=3, name="bar",
+                                  resource=owner.userresource_set.all()[0]))
+
+        fork = Droplet.objects.get(pk=d.pk).fork(3)
+        self.assertEqual(fork.name, "foo")
+        self.assertEqual(fork.revisions, 2)
+        self.assertEqual(fork.content_sha256, r.content_sha256)
+        self.assertEqual(fork.dropletrevision_set.count(), 2)
+        self.assertEqual(Blob.objects.get(sha256=r.content_sha256).refcount, 2)
+        self.assertEqual(UserProfile.objects.get(user=owner).personal_quota,
+                         profile.calculate_quota())
+
+        # the newest content of a fork is never a delta
+        head = Droplet.objects.get(pk=d.pk).fork(2).dropletrevision_set.get()
+        self.assertEqual(head.content.read(), '12345')
+        self.assertFalse(head.delta)
+
+        # forks keep their content when the original goes away
+        d.delete()
+        first = fork.dropletrevision_set.get(number=1)
+        self.assertEqual(first.content.read(), '12345')
+        self.assertEqual(UserProfile.objects.get(user=owner).personal_quota,
+                         profile.calculate_quota())
+
+class QuotaTest(AuthTestCase):
+    def setUp(self):
+        self.users = {
+            'owner': self.create_user("foo", "foo@example.com"),
+            'user': self.create_user(),
+            }
+
+    def assertQuota(self, user, personal_quota, shared_quota):
+        profile = UserProfile.objects.get(user=user)
+        self.assertEqual(profile.personal_quota, personal_quota)
+        self.assertEqual(profile.shared_quota, shared_quota)
+
+        # incremental updates match a full recalculation
+        self.assertEqual(profile.calculate_quota(), personal_quota)
+        self.assertEqual(profile.calculate_shared_quota(), shared_quota)
+
+    def test_incremental_quota(self):
+        """
+        Test that quota follows uploads, shares, moves and deletions
+        """
+        owner = self.users['owner']['object']
+        user = self.users['user']['object']
+        root = owner.cell_set.all()[0]
+
+        c = Cell.objects.create(owner=owner, name="shared", parent=root)
+        Share.objects.create(cell=c, user=user)
+
+        d = make_droplet(owner=owner, name="foo", cell=root)
+        self.assertQuota(owner, 5, 0)
+        self.assertQuota(user, 0, 0)
+
+        d.dropletrevision_set.add(DropletRevision(number=2, cell=c,
+                                  resource=owner.userresource_set.all()[0]))
+        self.assertQuota(owner, 5, 0)
+        self.assertQuota(user, 0, 5)
+
+        make_droplet(owner=owner, name="bar", cell=c)
+        self.assertQuota(user, 0, 10)
+
+        Droplet.objects.get(pk=d.pk).set_deleted()
+        self.assertQuota(owner, 5, 0)
+        self.assertQuota(user, 0, 5)
+
+        sub = Cell.objects.create(owner=owner, name="sub", parent=root)
+        make_droplet(owner=owner, name="baz", cell=sub)
+        self.assertQuota(owner, 10, 0)
+        self.assertQuota(user, 0, 5)
+
+        sub = Cell.objects.get(pk=sub.pk)
+        sub.parent = c
+        sub.save()
+        self.assertQuota(user, 0, 10)
+
+        Share.objects.all().delete()
+        self.assertQuota(user, 0, 0)
+
+        Droplet.objects.all().delete()
+        self.assertQuota(owner, 0, 0)
+
+    def test_delete_cell_subtree(self):
+        """
+        Test that deleting a cell marks its subtree deleted and updates
+        quota once for all of it
+        """
+        owner = self.users['owner']['object']
+        user = self.users['user']['object']
+        root = owner.cell_set.all()[0]
+
+        c = Cell.objects.create(owner=owner, name="c", parent=root)
+        sub = Cell.objects.create(owner=owner, name="sub", parent=c)
+        Share.objects.create(cell=sub, user=user)
+        make_droplet(owner=owner, name="foo", cell=c)
+        make_droplet(owner=owner, name="bar", cell=sub)
+        make_droplet(owner=owner, name="baz", cell=root)
+        self.assertQuota(owner, 15, 0)
+        self.assertQuota(user, 0, 5)
+
+        cursor = Change.latest_id()
+        Cell.objects.get(pk=c.pk).set_deleted()
+
+        self.assertEqual(
+            set(Cell.objects.filter(deleted=True).values_list('pk', flat=True)),
+            set([c.pk, sub.pk]))
+        self.assertEqual(
+            set(Droplet.objects.filter(deleted=True).values_list('name', flat=True)),
+            set([u'foo', u'bar']))
+        self.assertQuota(owner, 5, 0)
+        self.assertQuota(user, 0, 0)
+
+        # a single subtree entry covers the droplets
+        self.assertEqual(Change.objects.filter(sequence__isnull=True,
+                                               droplet__isnull=False).count(), 0)
+        self.assertTrue(Change.objects.filter(sequence__isnull=True, cell=c,
+                                              subtree=True).exists())
+
+class RetentionTest(AuthTestCase):
+    def setUp(self):
+        self.users = {
+            'owner': self.create_user("foo", "foo@example.com"),
+            }
+
+    def test_expired_revisions(self):
+        """
+        Test that revisions expire according to the retention policy
+        and that the prune command deletes them
+        """
+        owner = self.users['owner']['object']
+        now = datetime(2012, 1, 31, 12)
+
+        d = make_droplet(owner=owner, name="foo", cell=owner.cell_set.all()[0])
+        for number in range(2, 7):
+            d.dropletrevision_set.add(DropletRevision(number=number,
+                                      name="foo%s" % number,
+                                      resource=owner.userresource_set.all()[0]))
+
+        for number, age in ((1, timedelta(days=20)),
+                            (2, timedelta(days=10)),
+                            (3, timedelta(days=3, hours=6)),
+                            (4, timedelta(days=3)),
+                            (5, timedelta(days=1)),
+                            (6, timedelta(0))):
+            d.dropletrevision_set.filter(number=number).\
+                update(created=now - age)
+
+        def expired(*args, **kwargs):
+            pks = d.expired_revisions(now=now, *args, **kwargs)
+            return set(DropletRevision.objects.filter(pk__in=pks).\
+                       values_list('number', flat=True))
+
+        # the first revision holds the only content, it never expires
+        self.assertEqual(expired(2, days=5), set([2, 3]))
+        self.assertEqual(expired(2, days=5, weeks=2), set([3]))
+        self.assertEqual(expired(2, days=5, max_bytes=0), set([2, 3, 4, 5]))
+
+        out = StringIO()
+        call_command('mls_prune', last=1, stdout=out)
+        self.assertEqual(out.getvalue(), "Deleted 4 revisions\n")
+        # waiters are woken once each batch committed
+        self.assertFalse(notify._local.pending)
+        self.assertEqual(
+            list(d.dropletrevision_set.values_list('number', flat=True)),
+            [1, 6])
+        self.assertEqual(Droplet.objects.get(pk=d.pk).revisions, 6)
+
+        # nothing left at or below the revision asked for
+        d.dropletrevision_set.filter(number=1).delete()
+        response = self.client.get(
+            '/api/droplet/%s/revision/3/content/' % d.pk,
+            **self.users['owner']['auth'])
+        self.assertEqual(response.status_code, 404)
+
+    def test_expired_revisions_state(self):
+        """
+        Test that kept revisions can still be read after pruning, when
+        their name and content come from older revisions
+        """
+        owner = self.users['owner']['object']
+        resource = owner.userresource_set.all()[0]
+        now = datetime.now()
+
+        d = make_droplet(owner=owner, name="foo", cell=owner.cell_set.all()[0])
+        d.dropletrevision_set.add(DropletRevision(number=2, name="bar",
+                                                  resource=resource))
+        f = tempfile.NamedTemporaryFile()
+        f.write('56789')
+        f.seek(0)
+        r = DropletRevision(number=3,
+                            content_sha256='f76043a74ec33b6aefbb289050faf7aa8d482095477397e3e63345125d49f527',
+                            resource=resource)
+        r.content.save('foo', File(f), save=False)
+        d.dropletrevision_set.add(r)
+
+        for number, age in ((1, timedelta(days=20)),
+                            (2, timedelta(days=1)),
+                            (3, timedelta(0))):
+            d.dropletrevision_set.filter(number=number).\
+                update(created=now - age)
+
+        # 2 is kept for its day and reads the content of 1, 3 reads
+        # the name of 2
+        self.assertEqual(d.expired_revisions(1, days=5), [])
+        call_command('mls_prune', last=1, days=5, stdout=StringIO())
+
+        auth = self.users['owner']['auth']
+        response = self.client.get(
+            '/api/droplet/%s/revision/2/content/' % d.pk, **auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join(response), '12345')
+        response = self.client.get(
+            '/api/droplet/%s/revision/3/content/' % d.pk, **auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(''.join(response), '56789')
+        self.assertTrue('bar' in response['Content-Disposition'])
+
+class ChunkedStorageTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = ChunkedStorage(64, location=self.location)
+        self.blob_storage = mls_models.blob_storage
+        mls_models.blob_storage = mls_chunk.blob_storage = self.storage
+
+    def tearDown(self):
+        mls_models.blob_storage = mls_chunk.blob_storage = self.blob_storage
+        shutil.rmtree(self.location)
+
+    def _save(self, data):
+        sha256 = hashlib.sha256(data).hexdigest()
+        name = calculate_blob_path(sha256)
+        self.storage.save(name, ContentFile(data))
+        Blob.add_reference(sha256)
+        return name
+
+    def _chunks(self):
+        return sum(len(filenames) for directory, dirnames, filenames in
+                   os.walk(os.path.join(self.location, 'chunks')))
+
+    def test_split_chunks(self):
+        """
+        Test that chunk boundaries do not depend on how content is read
+        """
+        data = ''.join(hashlib.sha256(str(i)).digest() for i in range(4096))
+        chunks = list(split_chunks(ContentFile(data), 1024))
+        self.assertEqual(''.join(chunks), data)
+        self.assertTrue(all(256 <= len(c) <= 4096 for c in chunks[:-1]))
+
+        content = ContentFile(data)
+        content.DEFAULT_CHUNK_SIZE = 1000
+        self.assertEqual(list(split_chunks(content, 1024)), chunks)
+
+    def test_shared_chunks(self):
+        """
+        Test that similar files share chunks once chunked, read back
+        whole and that chunks are collected with their last blob
+        """
+        data = ''.join(hashlib.sha256(str(i)).digest() for i in range(128))
+        changed = data[:2000] + 'foo' + data[2000:]
+
+        # uploads are stored whole, chunking happens offline
+        name = self._save(data)
+        changed_name = self._save(changed)
+        self.assertEqual(self._chunks(), 0)
+        self.assertEqual(self.storage.open(name).read(), data)
+
+        out = StringIO()
+        call_command('mls_chunk', stdout=out)
+        self.assertEqual(out.getvalue(), "Chunked 2 blobs\n")
+        self.assertFalse(Chunk.chunk_blob(hashlib.sha256(data).hexdigest()))
+
+        # only the chunks around the change are not shared
+        self.assertEqual(Chunk.objects.count(), self._chunks())
+        self.assertTrue(Chunk.objects.filter(refcount__gt=1).count() >
+                        self._chunks() / 2)
+        self.assertEqual(self.storage.size(changed_name), len(changed))
+
+        f = self.storage.open(changed_name)
+        self.assertEqual(f.read(), changed)
+        f.seek(1990)
+        self.assertEqual(f.read(20), changed[1990:2010])
+        f.close()
+
+        fileobj = FieldFile(None, Droplet._meta.get_field('content'),
+                            changed_name)
+        fileobj.storage = self.storage
+        response = common.basic_sendfile(fileobj)
+        self.assertEqual(response['Content-Length'], str(len(changed)))
+        self.assertEqual(''.join(response), changed)
+
+        # chunks only the collected blob lists go with it, counting
+        # the bytes of their files
+        chunks = set(Chunk.objects.filter(refcount=1).\
+                     values_list('sha256', flat=True))
+        unique = sum(size for sha256, size in
+                     self.storage.read_manifest(changed_name)
+                     if sha256 in chunks)
+        manifest = os.path.getsize(self.storage.path(changed_name))
+        Blob.remove_reference(hashlib.sha256(changed).hexdigest())
+        self.assertEqual(Blob.collect_garbage(timedelta(0)),
+                         manifest + unique)
+        self.assertEqual(Chunk.objects.count(), self._chunks())
+        self.assertEqual(self.storage.open(name).read(), data)
+
+    def test_uploaded_manifest(self):
+        """
+        Test that uploads looking like manifests are read as they are
+        and that damaged manifests are refused
+        """
+        data = MANIFEST_MAGIC + '../../../etc/passwd 1000000000\n'
+        name = self._save(data)
+        self.assertEqual(self.storage.read_manifest(name), None)
+        self.assertEqual(self.storage.size(name), len(data))
+        self.assertEqual(self.storage.open(name).read(), data)
+
+        call_command('mls_chunk', stdout=StringIO())
+        self.assertTrue(self.storage.path(name).startswith(
+            os.path.join(self.location, 'manifests', '')))
+        self.assertFalse(os.path.exists(os.path.join(self.location, name)))
+        self.assertEqual(self.storage.size(name), len(data))
+        self.assertEqual(self.storage.open(name).read(), data)
+
+        f = open(self.storage.path(name), 'ab')
+        f.write('../../../etc/passwd 1\n')
+        f.close()
+        self.assertRaises(ValueError, self.storage.read_manifest, name)
+
+        Blob.remove_reference(hashlib.sha256(data).hexdigest())
+        Blob.collect_garbage(timedelta(0))
+        self.assertFalse(self.storage.exists(name))
+
+class CompressedStorageTest(TestCase):
+    def setUp(self):
+        self.location = tempfile.mkdtemp()
+        self.storage = CompressedFileSystemStorage(location=self.location)
+
+    def tearDown(self):
+        shutil.rmtree(self.location)
+
+    def test_compressed_storage(self):
+        """
+        Test that files are compressed by type and read back whole
+        """
+        data = 'foo bar ' * 1000
+        text = ContentFile(data)
+        text.name = 'foo.txt'
+        name = self.storage.save('text', text)
+        image = ContentFile(data)
+        image.name = 'foo.jpg'
+        jpeg = self.storage.save('jpeg', image)
+
+        # names without an extension are typed by their first bytes
+        png = self.storage.save('png', ContentFile('\x89PNG' + data))
+
+        self.assertTrue(os.path.getsize(self.storage.path(name)) < len(data))
+        self.assertEqual(os.path.getsize(self.storage.path(jpeg)),
+                         len(data) + 64)
+        self.assertEqual(os.path.getsize(self.storage.path(png)),
+                         len(data) + 68)
+        for n in (name, jpeg):
+            self.assertEqual(self.storage.size(n), len(data))
+            self.assertEqual(self.storage.open(n).read(), data)
+
+            f = self.storage.open(n)
+            f.seek(4)
+            self.assertEqual(f.read(3), 'bar')
+            self.assertEqual(calculate_sha256(f),
+                             hashlib.sha256(data).hexdigest())
+            f.close()
+
+        # stored bytes are never taken for a header, and files from
+        # before compression are read as they are
+        forged = 'melissi-gzip 1 0'.ljust(63) + '\n' + data
+        image = ContentFile(forged)
+        image.name = 'forged.jpg'
+        forged_name = self.storage.save('forged', image)
+        legacy = open(self.storage.path('legacy'), 'wb')
+        legacy.write(forged)
+        legacy.close()
+        for n in (forged_name, 'legacy'):
+            self.assertEqual(self.storage.size(n), len(forged))
+            self.assertEqual(self.storage.open(n).read(), forged)
+
+        fileobj = FieldFile(None, Droplet._meta.get_field('patch'), name)
+        fileobj.storage = self.storage
+        response = common.basic_sendfile(fileobj)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(''.join(response), data)
+
+        # clients accepting gzip get the stored stream, tagged apart
+        # from the identity bytes
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        response = common.basic_sendfile(fileobj, request=request, etag='foo')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(response['ETag'], '"foo-gzip"')
+        body = ''.join(response)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(body)).read(), data)
+
+        # resuming the gzip stream gets all identity bytes
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip',
+                                       HTTP_RANGE='bytes=%d-' % (len(body) / 2),
+                                       HTTP_IF_RANGE='"foo-gzip"')
+        response = common.basic_sendfile(fileobj, request=request, etag='foo')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['ETag'], '"foo"')
+        self.assertEqual(''.join(response), data)
+
+class UploadHandlerTest(TestCase):
+    def _upload(self, handler, data):
+        handler.handle_raw_input(None, {}, len(data), None)
+        try:
+            handler.new_file('content', 'foo', 'text/plain', len(data))
+        except StopFutureHandlers:
+            # memory handler takes over the file
+            pass
+
+        for start in range(0, len(data), 2):
+            handler.receive_data_chunk(data[start:start+2], start)
+
+        return handler.file_complete(len(data))
+
+    def test_memory_upload_sha256(self):
+        """
+        Test that in memory uploads carry their sha256
+        """
+        f = self._upload(HashingMemoryFileUploadHandler(), '12345')
+        self.assertEqual(f.sha256,
+                         '5994471abb01112afcc18159f6cc74b4f511b99806da59b3caf5a9c173cacfc5')
+        self.assertEqual(calculate_sha256(f), f.sha256)
+
+    def test_temporary_upload_sha256(self):
+        """
+        Test that uploads streamed to disk carry their sha256
+        """
+        f = self._upload(HashingTemporaryFileUploadHandler(), '56789')
+        self.assertEqual(f.sha256,
+                         'f76043a74ec33b6aefbb289050faf7aa8d482095477397e3e63345125d49f527')
+        self.assertEqual(f.read(), '56789')
+
 class UserTest(AuthTestCase):
     def setUp(self):
         self.users = {
@@ -1339,6 +2816,21 @@ class UserTest(AuthTestCase):
             'owner': self.create_user("foo", "foo@example.com")
             }
 
+    def test_cached_authentication(self):
+        """
+        Test that cached credentials stop working with a new password
+        """
+        user = self.users['user']
+        url = '/api/user/%s/' % user['object'].id
+
+        self.assertEqual(self.client.get(url, **user['auth']).status_code, 200)
+        self.assertEqual(self.client.get(url, **user['auth']).status_code, 200)
+
+        user['object'].set_password('456')
+        user['object'].save()
+        self.assertEqual(self.client.get(url, **user['auth']).status_code, 401)
+        self.assertEqual(self.client.get(url, **self.auth(user['username'], '456')).status_code, 200)
+
     @test_multiple_users
     def test_create_user(self):
         """
@@ -0,0 +1,62 @@
+"""
+Upload handlers that hash files while they are being received.
+
+The sha256 hexdigest of every uploaded file is attached to the
+UploadedFile as `sha256`, so verifying the upload does not need
+another pass over the data. See common.calculate_sha256
+
+StagedUploadedFile wraps content uploaded in chunks through an
+UploadSession.
+"""
+import os
+import hashlib
+
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import MemoryFileUploadHandler,\
+     TemporaryFileUploadHandler
+
+class HashingUploadHandlerMixin(object):
+    def new_file(self, *args, **kwargs):
+        self._sha256 = hashlib.sha256()
+        return super(HashingUploadHandlerMixin, self).new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        data = super(HashingUploadHandlerMixin, self).receive_data_chunk(raw_data,
+                                                                         start)
+        if data is None:
+            # chunk consumed by this handler
+            self._sha256.update(raw_data)
+
+        return data
+
+    def file_complete(self, file_size):
+        uploaded_file = super(HashingUploadHandlerMixin, self).file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.sha256 = self._sha256.hexdigest()
+
+        return uploaded_file
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin,
+                                     MemoryFileUploadHandler):
+    pass
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin,
+                                        TemporaryFileUploadHandler):
+    pass
+
+class StagedUploadedFile(UploadedFile):
+    """
+    A file staged on disk by an upload session. Storages link it
+    instead of copying, the staged file itself stays until the session
+    is deleted after commit.
+    """
+    staged = True
+
+    def __init__(self, path, name):
+        super(StagedUploadedFile, self).__init__(open(path, 'rb'), name,
+                                                 None, os.path.getsize(path),
+                                                 None)
+        self._path = path
+
+    def temporary_file_path(self):
+        return self._path
@@ -86,6 +86,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'mlscommon.notify.NotifyMiddleware',
     'django.middleware.transaction.TransactionMiddleware',
 )
 
@@ -135,6 +136,12 @@ LOGGING = {
 
 AUTH_PROFILE_MODULE = 'mlscommon.UserProfile'
 
+# hash uploads while receiving them
+FILE_UPLOAD_HANDLERS = (
+    'mlscommon.uploadhandlers.HashingMemoryFileUploadHandler',
+    'mlscommon.uploadhandlers.HashingTemporaryFileUploadHandler',
+)
+
 APPEND_SLASH = True
 
 from local_settings import *